@@ -0,0 +1,198 @@
+import heapq
+from operator import itemgetter
+
+import numpy as np
+import pandas as pd
+
+from frame_io import iter_frame, read_frame, refresh_frame
+
+# ------------------------------
+# Event-driven backtest over date-ordered parity observations
+# ------------------------------
+#
+# Observations are streamed in date order through generators (read_events -> liquid_events ->
+# Backtester.run). Positions are kept per contract series in flat arrays, so every event is
+# O(1) work and nothing like x_next/y_next is ever built for the whole panel.
+
+EVENT_COLUMNS = ['Date', 'y', 'x', 'call_v', 'put_v', 'ulying_volume', 'contract', 'PV_alldivs']
+
+# Fields of an event tuple, in order.
+EVENT_FIELDS = ('day', 'contract', 'country', 'x', 'y', 'call_v', 'put_v', 'ulying_volume')
+
+
+def _frame_events(name, country, days, divs, chunk_size):
+    # A frame's rows are ordered by contract, not date, so each chunk gathers the next
+    # chunk_size rows in date order from the memory-mapped columns (see frame_io.read_frame).
+    df = read_frame(name, columns=EVENT_COLUMNS)
+    order = np.argsort(days, kind="stable")
+    for start in range(0, len(order), chunk_size):
+        rows = order[start:start + chunk_size]
+        chunk = df.iloc[rows]
+        x = chunk['x'] if divs else chunk['x'] + chunk['PV_alldivs']
+        yield from zip(days[rows].tolist(), chunk['contract'].tolist(),
+            [country] * len(rows), x.tolist(), chunk['y'].tolist(), chunk['call_v'].tolist(),
+            chunk['put_v'].tolist(), chunk['ulying_volume'].tolist())
+
+def read_events(names, divs=True, chunk_size=100000):
+    """
+    Returns (n_contracts, events): the number of contract ids, so a consumer can size its
+    state arrays, and a generator of one event tuple (see EVENT_FIELDS) per row of the
+    processed frames in names, in date order across all of them; country is the frame's
+    position in names. contract is the frame's contract column (see data2), so it does not
+    depend on row order or on which rows a filter such as liquid_events drops later, as in
+    data5.
+
+    Only the Date and contract columns are read up front, through iter_frame. The events of
+    each frame are then produced chunk_size rows at a time in date order, and the frames are
+    merged on the day with heapq.merge; within a day, rows keep their frame order.
+    """
+    n_contracts = 0
+    streams = []
+    for country, name in enumerate(names):
+        refresh_frame(name)
+        days = []
+        for chunk in iter_frame(name, columns=['Date', 'contract'], chunk_size=chunk_size):
+            days.append(chunk['Date'].to_numpy().astype("datetime64[D]").astype(np.int64))
+            if len(chunk):
+                n_contracts = max(n_contracts, int(chunk['contract'].max()) + 1)
+        days = np.concatenate(days) if days else np.empty(0, dtype=np.int64)
+        streams.append(_frame_events(name, country, days, divs, chunk_size))
+    return n_contracts, heapq.merge(*streams, key=itemgetter(0))
+
+def liquid_events(events, min_option_vol=10, min_ulying_vol=0.01):
+    """Drops illiquid observations, the same filter as simulate_trade's query."""
+    for event in events:
+        if event[5] > min_option_vol and event[6] > min_option_vol and event[7] > min_ulying_vol:
+            yield event
+
+
+class Backtester:
+    """
+    Parity-violation strategy with open positions.
+
+    An observation with |y - x| > fee opens a position on its contract when none is open:
+    long x (short y) if y > x, long y (short x) otherwise, with size max_trade_count = 10 %
+    of the smallest of the call, put and underlying volume, cut down to what the country's
+    free capital allows (a unit ties up |x| + |y|). The position is closed on a later
+    observation of the same contract, after max_holding observations or as soon as
+    |y - x| <= exit_error, with the better of the hedge and the close alternative of
+    data5.compute_lagged_profit. With max_holding=1 and no capital cap every trade's
+    unit_pnl is the lagged_profit of its entry row. Sizes are whole units (max_trade_count
+    rounded down), while data5 weights lagged_profit by the unrounded count, so totals differ.
+    """
+
+    def __init__(self, n_contracts, fees, capital=np.inf, max_holding=1, exit_error=None):
+        n_countries = len(fees)
+        self.fees = np.asarray(fees, dtype=float)
+        self.capital = np.broadcast_to(np.asarray(capital, dtype=float), (n_countries,)).copy()
+        self.max_holding = max_holding
+        self.exit_error = exit_error
+
+        # Per contract position state; side 0 means no open position.
+        self.side = np.zeros(n_contracts, dtype=np.int8)
+        self.size = np.zeros(n_contracts, dtype=np.int64)
+        self.entry_x = np.zeros(n_contracts)
+        self.entry_y = np.zeros(n_contracts)
+        self.entry_day = np.zeros(n_contracts, dtype=np.int64)
+        self.held = np.zeros(n_contracts, dtype=np.int64)
+        self.country = np.full(n_contracts, -1, dtype=np.int64)
+
+        # Per country capital and results.
+        self.reserved = np.zeros(n_countries)
+        self.max_reserved = np.zeros(n_countries)
+        self.pnl = np.zeros(n_countries)
+        self.trades = []
+
+    def on_event(self, day, contract, country, x, y, call_v, put_v, ulying_volume):
+        error = y - x
+        fee = self.fees[country]
+        side = self.side[contract]
+        if side != 0:
+            self.held[contract] += 1
+            converged = self.exit_error is not None and abs(error) <= self.exit_error
+            if self.held[contract] >= self.max_holding or converged:
+                self.close(day, contract, country, x, y, fee)
+                side = 0
+        if side == 0 and abs(error) > fee:
+            self.open(day, contract, country, x, y, min(call_v, put_v, ulying_volume) * 0.1)
+
+    def open(self, day, contract, country, x, y, max_trade_count):
+        unit_capital = abs(x) + abs(y)
+        free = self.capital[country] - self.reserved[country]
+        size = int(max_trade_count)
+        if unit_capital > 0:
+            size = min(size, int(free / unit_capital)) if np.isfinite(free) else size
+        if size <= 0:
+            return
+        self.side[contract] = 1 if y > x else -1
+        self.size[contract] = size
+        self.entry_x[contract] = x
+        self.entry_y[contract] = y
+        self.entry_day[contract] = day
+        self.held[contract] = 0
+        self.country[contract] = country
+        self.reserved[country] += size * unit_capital
+        self.max_reserved[country] = max(self.max_reserved[country], self.reserved[country])
+
+    def close(self, day, contract, country, x, y, fee):
+        entry_x, entry_y = self.entry_x[contract], self.entry_y[contract]
+        if self.side[contract] > 0:
+            # Long x: hedge by shorting y, or sell x.
+            unit_pnl = max(y - entry_x, x - entry_x) - fee
+        else:
+            # Long y: hedge by shorting x, or sell y.
+            unit_pnl = max(x - entry_y, y - entry_y) - fee
+        size = self.size[contract]
+        unit_capital = abs(entry_x) + abs(entry_y)
+        self.reserved[country] -= size * unit_capital
+        self.pnl[country] += unit_pnl * size
+        self.trades.append((contract, country, self.entry_day[contract], day,
+            int(self.side[contract]), size, unit_pnl, unit_pnl * size, unit_pnl / unit_capital))
+        self.side[contract] = 0
+
+    def run(self, events):
+        for event in events:
+            self.on_event(*event)
+        return self
+
+    def trade_log(self, countries=None):
+        log = pd.DataFrame(self.trades, columns=['contract', 'country', 'entry_date',
+            'exit_date', 'side', 'size', 'unit_pnl', 'pnl', 'return'])
+        for col in ('entry_date', 'exit_date'):
+            log[col] = log[col].to_numpy(dtype=np.int64).astype("datetime64[D]").astype("datetime64[ns]")
+        if countries is not None:
+            log['country'] = np.asarray(countries, dtype=object)[log['country'].to_numpy(dtype=int)]
+        return log
+
+    def summary(self, countries=None):
+        log = self.trade_log()
+        rows = []
+        for c in range(len(self.fees)):
+            trades = log[log['country'] == c]
+            rows.append({
+                'country': countries[c] if countries is not None else c,
+                'trades': len(trades),
+                'total_profit': self.pnl[c],
+                'mean_return': trades['return'].mean(),
+                'max_capital_used': self.max_reserved[c],
+                'open_at_end': int(np.count_nonzero((self.side != 0) & (self.country == c))),
+            })
+        return pd.DataFrame(rows)
+
+
+def run_backtest(names, fees, countries=None, divs=True, capital=np.inf, max_holding=1,
+        exit_error=None, min_option_vol=10):
+    """Streams the processed frames in names through a Backtester; returns (summary, trade log)."""
+    n_contracts, events = read_events(names, divs)
+    bt = Backtester(n_contracts, fees, capital, max_holding, exit_error)
+    bt.run(liquid_events(events, min_option_vol))
+    return bt.summary(countries), bt.trade_log(countries)
+
+
+if __name__ == "__main__":
+    datas_list = ['dk_processed_data', 'no_processed_data', 'se_processed_data']
+    sek_fees = 30.0
+    fees = [sek_fees*1.45, sek_fees*0.96, sek_fees]
+    countries = ['Denmark', 'Norway', 'Sweden']
+    summary, trades = run_backtest(datas_list, fees, countries, capital=1e7, max_holding=5)
+    print(summary.to_string(index=False))
@@ -0,0 +1,489 @@
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+import data5
+import eep
+import synthetic
+from data2 import (calculate_pv_alldivs, calculate_pv_alldivs_vectorized, get_iv, get_iv_vectorized,
+    get_risk_free_rate, process_option_group, filter_option_group, run_group_frames)
+from data4 import winsorize_errors
+from rates import RATE_MAPPINGS, RateCurve
+
+# ------------------------------
+# Benchmarks for the pipeline hot paths
+# ------------------------------
+
+def random_iv_inputs(n_rows, seed=0):
+    """
+    Random option rows shaped like the kovadata3 panel: prices around 100, strikes within
+    +-30 %, maturities up to 15 months and rates in the 0-5 % range. Market prices are generated
+    from the same Black formula get_iv inverts, with a known volatility between 10 % and 80 %.
+    """
+    rng = np.random.default_rng(seed)
+    index = pd.date_range("2011-01-03", periods=n_rows, freq="h")
+    S = pd.Series(rng.uniform(50, 150, n_rows), index=index)
+    K = S * rng.uniform(0.7, 1.3, n_rows)
+    T = pd.Series(rng.uniform(7, 455, n_rows) / 365, index=index)
+    R = pd.Series(rng.uniform(0.0, 0.05, n_rows), index=index)
+    sigma = rng.uniform(0.1, 0.8, n_rows)
+    d1 = (np.log(S / K) + (R + sigma**2 / 2) * T) / (sigma * np.sqrt(T))
+    d2 = d1 - sigma * np.sqrt(T)
+    call_price = np.exp(-R * T) * (S * norm.cdf(d1) - K * norm.cdf(d2))
+    put_price = np.exp(-R * T) * (K * norm.cdf(-d2) - S * norm.cdf(-d1))
+    return S, K, R, T, call_price, put_price, sigma
+
+
+def bench_iv(sizes=(100, 1000, 5000), seed=0):
+    """
+    Times get_iv against get_iv_vectorized on the same rows and reports the speedup and the
+    largest difference between the two on rows where the scalar solver converged.
+    """
+    results = []
+    for n_rows in sizes:
+        S, K, R, T, call_price, put_price, sigma = random_iv_inputs(n_rows, seed)
+        for call, price in ((True, call_price), (False, put_price)):
+            start = time.perf_counter()
+            iv_loop = get_iv(S, K, R, T, price, call)
+            t_loop = time.perf_counter() - start
+
+            start = time.perf_counter()
+            iv_vec = get_iv_vectorized(S, K, R, T, price, call)
+            t_vec = time.perf_counter() - start
+
+            converged = (iv_loop - sigma).abs() < 1e-4
+            results.append({
+                'rows': n_rows,
+                'call': call,
+                'loop_s': t_loop,
+                'vectorized_s': t_vec,
+                'speedup': t_loop / t_vec,
+                'max_abs_diff': (iv_loop - iv_vec)[converged].abs().max(),
+                'max_abs_err_vectorized': (iv_vec - sigma).abs().max(),
+            })
+            print(results[-1])
+    return pd.DataFrame(results)
+
+
+def random_pv_inputs(n_days, n_divs, country="SWEDEN", seed=0):
+    """
+    One option group over n_days business days with n_divs dividend days, long maturities
+    and a rates frame carrying the country's tenor columns with some missing values.
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range("2011-01-03", periods=n_days)
+    dividend = np.zeros(n_days)
+    dividend[rng.choice(n_days, n_divs, replace=False)] = rng.uniform(0.5, 5, n_divs)
+    df = pd.DataFrame({
+        'ulying_div': dividend,
+        'maturity': rng.integers(1, 455, n_days) / 365,
+    }, index=pd.Index(dates, name='Date'))
+
+    columns = sorted(set(RATE_MAPPINGS[country].values()))
+    rate_dates = pd.bdate_range("2010-12-01", periods=n_days + 40)
+    rates = pd.DataFrame(rng.uniform(0, 5, (len(rate_dates), len(columns))), index=rate_dates, columns=columns)
+    rates = rates.mask(rng.random(rates.shape) < 0.1)
+    rates.index.name = 'Date'
+    return df, rates
+
+
+def bench_pv_alldivs(sizes=((250, 4), (1000, 16), (2500, 40)), country="SWEDEN", seed=0):
+    """
+    Times calculate_pv_alldivs against calculate_pv_alldivs_vectorized for
+    (pricing days, dividend days) pairs and reports the largest PV_alldivs difference.
+    """
+    results = []
+    for n_days, n_divs in sizes:
+        df, rates = random_pv_inputs(n_days, n_divs, country, seed)
+        start = time.perf_counter()
+        pv_loop = calculate_pv_alldivs(df, rates, country)['PV_alldivs']
+        t_loop = time.perf_counter() - start
+
+        start = time.perf_counter()
+        pv_vec = calculate_pv_alldivs_vectorized(df, rates, country)['PV_alldivs']
+        t_vec = time.perf_counter() - start
+        results.append({
+            'days': n_days,
+            'dividends': n_divs,
+            'loop_s': t_loop,
+            'vectorized_s': t_vec,
+            'speedup': t_loop / t_vec,
+            'max_abs_diff': (pv_loop - pv_vec).abs().max(),
+        })
+        print(results[-1])
+    return pd.DataFrame(results)
+
+
+def american_option_price_psor(s0, k, t, r, sigma, smax, m, n, call, omega=1.2, tol=1e-3, max_iter=10000):
+    """
+    Line-by-line port of american_option_price_fd in calculate_eeps (one contract, PSOR), used
+    as the reference for the batched engine.
+    """
+    d_s = smax / m
+    dt = t / n
+    s_values = np.arange(m + 1) * d_s
+    if call:
+        payoff, low_bc, high_bc, min_value = np.maximum(s_values - k, 0), 0.0, smax - k, max(s0 - k, 0)
+    else:
+        payoff, low_bc, high_bc, min_value = np.maximum(k - s_values, 0), k, 0.0, max(k - s0, 0)
+    v_next = payoff.copy()
+    v_next[0], v_next[m] = low_bc, high_bc
+    for _ in range(n):
+        v = v_next.copy()
+        error, iter_count = 1.0, 0
+        while error > tol and iter_count < max_iter:
+            error = 0.0
+            for i in range(1, m):
+                alpha = 0.25 * dt * (sigma * sigma * i * i - r * i)
+                beta = -0.5 * dt * (sigma * sigma * i * i + r)
+                gamma = 0.25 * dt * (sigma * sigma * i * i + r * i)
+                d = alpha * v_next[i - 1] + (1 + beta) * v_next[i] + gamma * v_next[i + 1]
+                v_old = v[i]
+                new_val = (1 - omega) * v_old + (omega / (1 - beta)) * (d + alpha * v[i - 1] + gamma * v[i + 1])
+                intrinsic = s_values[i] - k if call else k - s_values[i]
+                v[i] = max(new_val, intrinsic)
+                error = max(error, abs(v[i] - v_old))
+            iter_count += 1
+        v_next = v
+    idx = min(int(np.floor(s0 / d_s)), m - 1)
+    price = v_next[idx] + (v_next[idx + 1] - v_next[idx]) * ((s0 - s_values[idx]) / d_s)
+    return max(price, min_value)
+
+
+def random_eep_inputs(n_rows, seed=0):
+    rng = np.random.default_rng(seed)
+    S = rng.uniform(50, 150, n_rows)
+    return pd.DataFrame({
+        'ulying_price': S,
+        'PV_alldivs': rng.uniform(0, 4, n_rows),
+        'strike': S * rng.uniform(0.7, 1.3, n_rows),
+        'maturity': rng.uniform(7, 455, n_rows) / 365,
+        'risk_free_rate': rng.uniform(-0.01, 0.05, n_rows),
+        'IV_put': rng.uniform(0.1, 0.6, n_rows),
+        'IV_call': rng.uniform(0.1, 0.6, n_rows),
+        'x': 0.0,
+    })
+
+
+def bench_eep(n_reference=20, sizes=(1000, 10000), m=eep.GRID_M, n=eep.GRID_N, seed=0):
+    """
+    Accuracy of eep.compute_eep_fd against the PSOR port on n_reference contracts with
+    calculate_eeps' grid (m = n = 100), and its throughput on larger batches.
+    """
+    df = random_eep_inputs(n_reference, seed)
+    s_adj = (df['ulying_price'] - df['PV_alldivs']).to_numpy()
+    sigma = ((df['IV_put'] + df['IV_call']) / 2).to_numpy()
+    K, T, r = df['strike'].to_numpy(), df['maturity'].to_numpy(), df['risk_free_rate'].to_numpy()
+
+    start = time.perf_counter()
+    ref_call, ref_put = [], []
+    for j in range(n_reference):
+        smax = max(2 * s_adj[j], 2 * K[j])
+        args = (s_adj[j], K[j], T[j], r[j], sigma[j], smax, m, n)
+        e_call = eep.euro_option_bs(s_adj[j], K[j], T[j], r[j], sigma[j], True)
+        e_put = eep.euro_option_bs(s_adj[j], K[j], T[j], r[j], sigma[j], False)
+        ref_call.append(max(american_option_price_psor(*args, call=True) - e_call, 0))
+        ref_put.append(max(american_option_price_psor(*args, call=False) - e_put, 0))
+    t_ref = (time.perf_counter() - start) / n_reference
+
+    eep_call, eep_put = eep.compute_eep_fd(df['ulying_price'], df['PV_alldivs'], K, T, r,
+        df['IV_put'], df['IV_call'], m=m, n=n)
+    results = {
+        'max_abs_diff_call': np.max(np.abs(eep_call - ref_call)),
+        'max_abs_diff_put': np.max(np.abs(eep_put - ref_put)),
+        'mean_put_eep': np.mean(ref_put),
+        'psor_s_per_row': t_ref,
+    }
+    for n_rows in sizes:
+        batch = random_eep_inputs(n_rows, seed)
+        start = time.perf_counter()
+        eep.add_eep(batch, m=m, n=n)
+        elapsed = time.perf_counter() - start
+        results[f'batched_s_per_row_{n_rows}'] = elapsed / n_rows
+    print(results)
+    return results
+
+
+def bench_eep_surface(n_rows=20000, tols=(0.01, 0.05), path=eep.SURFACE_PATH, seed=0):
+    """
+    eep.compute_eep_surface against eep.compute_eep_fd on the same rows: the share of rows
+    answered from the surface, the largest error on those rows and the time per row. The
+    surface is built first if path does not exist.
+    """
+    df = random_eep_inputs(n_rows, seed)
+    args = [df[c].to_numpy() for c in ('ulying_price', 'PV_alldivs', 'strike', 'maturity',
+        'risk_free_rate', 'IV_put', 'IV_call')]
+    start = time.perf_counter()
+    eep.get_eep_surface(path)
+    results = {'load_or_build_s': time.perf_counter() - start}
+
+    start = time.perf_counter()
+    fd_call, fd_put = eep.compute_eep_fd(*args)
+    results['fd_s_per_row'] = (time.perf_counter() - start) / n_rows
+
+    surface = eep.get_eep_surface(path)
+    K = args[2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        _, _, call_err, put_err = surface.lookup((args[0] - args[1]) / K, args[3], args[4],
+            (args[5] + args[6]) / 2)
+    for tol in tols:
+        start = time.perf_counter()
+        s_call, s_put = eep.compute_eep_surface(*args, tol=tol, path=path)
+        elapsed = time.perf_counter() - start
+        hit = (call_err * K <= tol) & (put_err * K <= tol)
+        results[f'tol_{tol}'] = {
+            'hit_rate': hit.mean(),
+            'max_abs_diff_call': np.max(np.abs(s_call - fd_call)[hit], initial=0.0),
+            'max_abs_diff_put': np.max(np.abs(s_put - fd_put)[hit], initial=0.0),
+            's_per_row': elapsed / n_rows,
+        }
+    print(results)
+    return results
+
+
+def bench_eep_baw(sizes=(10000, 100000), n_reference=5000, seed=0):
+    """
+    Error of eep.compute_eep_baw against the finite-difference premiums on n_reference rows
+    (overall and on rows with negative rates, where calls have a premium), and its time per
+    row next to compute_eep_fd's on larger batches.
+    """
+    df = random_eep_inputs(n_reference, seed)
+    args = [df[c].to_numpy() for c in ('ulying_price', 'PV_alldivs', 'strike', 'maturity',
+        'risk_free_rate', 'IV_put', 'IV_call')]
+    start = time.perf_counter()
+    fd_call, fd_put = eep.compute_eep_fd(*args)
+    t_fd = (time.perf_counter() - start) / n_reference
+    baw_call, baw_put = eep.compute_eep_baw(*args)
+    negative = args[4] < 0
+    results = {
+        'max_abs_diff_call': np.max(np.abs(baw_call - fd_call)),
+        'mean_abs_diff_call_negative_rates': np.mean(np.abs(baw_call - fd_call)[negative]),
+        'max_abs_diff_put': np.max(np.abs(baw_put - fd_put)),
+        'mean_abs_diff_put': np.mean(np.abs(baw_put - fd_put)),
+        'mean_put_eep': np.mean(fd_put),
+        'fd_s_per_row': t_fd,
+    }
+    for n_rows in sizes:
+        batch = random_eep_inputs(n_rows, seed)
+        start = time.perf_counter()
+        eep.add_eep(batch, method="baw")
+        results[f'baw_s_per_row_{n_rows}'] = (time.perf_counter() - start) / n_rows
+    print(results)
+    return results
+
+
+def random_trade_frame(n_series, n_days, seed=0):
+    """
+    A processed frame of n_series contract series (told apart by the contract column), n_days
+    rows each, with falling maturity.
+    """
+    rng = np.random.default_rng(seed)
+    n_rows = n_series * n_days
+    x = np.repeat(rng.uniform(-20, 20, n_series), n_days) + rng.normal(0, 1, n_rows)
+    return pd.DataFrame({
+        'y': x + rng.normal(0, 1, n_rows),
+        'x': x,
+        'strike': np.repeat(rng.uniform(50, 150, n_series).round(), n_days),
+        'maturity': np.tile(np.arange(n_days, 0, -1) / 365, n_series),
+        'call_v': rng.uniform(0, 500, n_rows),
+        'put_v': rng.uniform(0, 500, n_rows),
+        'ulying_volume': rng.uniform(0, 1e6, n_rows),
+        'PV_alldivs': rng.uniform(0, 4, n_rows),
+        'contract': np.repeat(np.arange(n_series), n_days),
+    })
+
+
+def bench_lagged_profit(sizes=((50, 200), (200, 250), (1000, 250)), fees=1.0, seed=0):
+    """
+    data5.lagged_profit against the row-wise compute_lagged_profit (fed with the same
+    per-series next observations) and the speedup of simulate_trade's lagged path.
+    """
+    results = []
+    for n_series, n_days in sizes:
+        df = random_trade_frame(n_series, n_days, seed)
+        series = data5.contract_series(df)
+        ref = df.assign(x_next=df['x'].groupby(series).shift(-1),
+            y_next=df['y'].groupby(series).shift(-1))
+        start = time.perf_counter()
+        expected = ref.apply(lambda row: data5.compute_lagged_profit(row, fees), axis=1)
+        t_apply = time.perf_counter() - start
+        start = time.perf_counter()
+        got = data5.lagged_profit(df, fees)
+        t_vec = time.perf_counter() - start
+        results.append({
+            'rows': len(df),
+            'apply_s': t_apply,
+            'vectorized_s': t_vec,
+            'speedup': t_apply / t_vec,
+            'max_abs_diff': np.nanmax(np.abs(expected.to_numpy(dtype=float) - got.to_numpy())),
+        })
+    print(pd.DataFrame(results).to_string(index=False))
+    return results
+
+
+# ------------------------------
+# Pipeline benchmark suite on synthetic panels
+# ------------------------------
+
+SUITE_DIR = "benchmark_results"
+
+
+def best_time(fn, repeat=3):
+    """Best wall time of repeat calls of fn (its prints suppressed) and its last result."""
+    best = np.inf
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = fn()
+            best = min(best, time.perf_counter() - start)
+    return best, result
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"],
+            capture_output=True, text=True, check=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def suite_panel(n_contracts, n_days, seed=0):
+    """
+    A synthetic panel (see synthetic.py): the filtered 9-column groups, the rates frame and
+    the processed rows of every group.
+    """
+    options = synthetic.synthetic_options(n_contracts, n_days, seed=seed)
+    rate_dates = synthetic.synthetic_dates(n_days + 22, options.index[0] - pd.offsets.BDay(22))
+    rates = synthetic.synthetic_rates(rate_dates, seed)
+    groups = [filter_option_group(options.iloc[:, i:i + 9]) for i in range(0, options.shape[1], 9)]
+    groups = [g for g in groups if not g.empty]
+    with contextlib.redirect_stdout(io.StringIO()):
+        processed = [process_option_group(0, g, rates).assign(contract=c)
+            for c, g in enumerate(groups)]
+    return groups, rates, processed
+
+def run_suite(sizes=(8, 32, 128), n_days=750, worker_counts=(1, 2, 4), repeat=3, loop_rows=2000,
+        out_dir=SUITE_DIR, seed=0):
+    """
+    Times the pipeline hot paths on synthetic panels of every size (number of contracts,
+    n_days business days each) and run_group_frames for every worker count. The row-wise
+    get_iv and calculate_pv_alldivs only get about loop_rows rows, as they are slow.
+
+    Writes {meta, results} to out_dir/<timestamp>_<commit>.json for compare_suites; every
+    result has the benchmark, contracts, rows, workers, seconds and us_per_row.
+    """
+    results = []
+
+    def record(benchmark, n_contracts, rows, seconds, workers=1):
+        results.append({'benchmark': benchmark, 'contracts': n_contracts, 'rows': int(rows),
+            'workers': workers, 'seconds': seconds, 'us_per_row': seconds / max(rows, 1) * 1e6})
+        print(results[-1])
+
+    for n_contracts in sizes:
+        groups, rates, processed = suite_panel(n_contracts, n_days, seed)
+        # get_iv looks rows up by label, so the panel gets a unique index.
+        panel = pd.concat(processed).reset_index()
+        n_rows = len(panel)
+
+        S, K = panel['ulying_price'], panel['strike']
+        R, T = panel['risk_free_rate'], panel['maturity']
+        loop = slice(0, loop_rows)
+        seconds, _ = best_time(lambda: get_iv(S[loop], K[loop], R[loop], T[loop],
+            panel['call_price'][loop], True), repeat)
+        record('get_iv', n_contracts, len(S[loop]), seconds)
+        seconds, _ = best_time(lambda: get_iv_vectorized(S, K, R, T, panel['call_price'], True), repeat)
+        record('get_iv_vectorized', n_contracts, n_rows, seconds)
+
+        # Whole groups up to about loop_rows rows for the row-wise version.
+        loop_groups, rows = [], 0
+        for frame in processed:
+            if rows >= loop_rows:
+                break
+            loop_groups.append(frame)
+            rows += len(frame)
+        pv_inputs = [frame[['Date', 'ulying_div', 'maturity']] for frame in processed]
+        countries = [frame['country'].iloc[0] for frame in processed]
+        seconds, _ = best_time(lambda: [calculate_pv_alldivs(df, rates, c)
+            for df, c in zip(pv_inputs[:len(loop_groups)], countries)], repeat)
+        record('calculate_pv_alldivs', n_contracts, rows, seconds)
+        curves = {c: RateCurve.from_frame(rates, c) for c in RATE_MAPPINGS}
+        seconds, _ = best_time(lambda: [calculate_pv_alldivs_vectorized(df, None, c, curves[c])
+            for df, c in zip(pv_inputs, countries)], repeat)
+        record('calculate_pv_alldivs_vectorized', n_contracts, n_rows, seconds)
+
+        seconds, _ = best_time(lambda: [get_risk_free_rate(frame['maturity'], c,
+            pd.DatetimeIndex(frame['Date']), curves[c]) for frame, c in zip(processed, countries)], repeat)
+        record('get_risk_free_rate', n_contracts, n_rows, seconds)
+
+        seconds, _ = best_time(lambda: [process_option_group(0, g, rates) for g in groups], repeat)
+        record('process_option_group', n_contracts, n_rows, seconds)
+        for workers in worker_counts:
+            seconds, _ = best_time(lambda: run_group_frames(iter(groups), n_jobs=workers,
+                backend="loky", rates_o=rates), repeat)
+            record('run_group_frames', n_contracts, n_rows, seconds, workers)
+
+        for lag in (False, True):
+            seconds, _ = best_time(lambda: data5.simulate_trade(panel.copy(), True, 1.0, lag), repeat)
+            record(f"simulate_trade{'_lag' if lag else ''}", n_contracts, n_rows, seconds)
+
+        seconds, _ = best_time(lambda: winsorize_errors(panel.copy(), 0.01), repeat)
+        record('winsorize_errors', n_contracts, n_rows, seconds)
+        seconds, _ = best_time(lambda: winsorize_errors(panel.copy(), 0.01, eps=0.001), repeat)
+        record('winsorize_errors_sketch', n_contracts, n_rows, seconds)
+
+    commit = git_commit()
+    meta = {
+        'commit': commit,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'cpu_count': os.cpu_count(),
+        'sizes': list(sizes), 'n_days': n_days, 'worker_counts': list(worker_counts),
+        'repeat': repeat, 'seed': seed,
+    }
+    os.makedirs(out_dir, exist_ok=True)
+    stem = os.path.join(out_dir, f"{datetime.now():%Y%m%d-%H%M%S}_{commit[:12]}")
+    path, n = stem + ".json", 1
+    while os.path.exists(path):
+        path, n = f"{stem}_{n}.json", n + 1
+    with open(path, "w") as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+    print("written to", path)
+    return path
+
+def compare_suites(base_path, new_path, threshold=1.2):
+    """
+    Per (benchmark, contracts, workers), the time of new_path's run relative to
+    base_path's; ratios above threshold are flagged as regressions.
+    """
+    keys = ['benchmark', 'contracts', 'workers']
+    frames = []
+    for path in (base_path, new_path):
+        with open(path) as f:
+            frames.append(pd.DataFrame(json.load(f)['results']).set_index(keys)['seconds'])
+    table = pd.concat(frames, axis=1, keys=['base_s', 'new_s']).dropna()
+    table['ratio'] = table['new_s'] / table['base_s']
+    table['regression'] = table['ratio'] > threshold
+    print(table.to_string())
+    return table.reset_index()
+
+
+if __name__ == "__main__":
+    bench_iv()
+    bench_pv_alldivs()
+    bench_eep()
+    bench_eep_surface()
+    bench_eep_baw()
+    bench_lagged_profit()
+    run_suite()
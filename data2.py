@@ -6,23 +6,10 @@ import matplotlib.pyplot as plt
 import time
 from joblib import Parallel, delayed
 
-# ------------------------------
-# Read Data and Prepare Options
-# ------------------------------
-
-# Read risk-free rates if needed
-rates_o = pd.read_csv("unprocessed_data/risk_free_rates2.csv", parse_dates=['Date'], index_col='Date')
-# Read options data; note that the index is set and then converted to datetime
-options = pd.read_csv("unprocessed_data/kovadata3.csv", header=[0, 1, 2])
-options = options.set_index('Date')
-# The index contains tuples; we take the first element and convert to datetime
-options.index = options.index.map(lambda x: x[0])
-options.index = pd.to_datetime(options.index, format='%m/%d/%y')
-
-# Initialize empty DataFrames for each country.
-linreg_dk = pd.DataFrame()
-linreg_se = pd.DataFrame()
-linreg_no = pd.DataFrame()
+from eep import DEFAULT_EEP_METHOD, add_eep
+from frame_io import write_frame
+from ingest import build_options_store, iter_group_frames
+from rates import RateCurve, build_rate_store, get_rate_curve, get_rate_mapping, to_day_numbers
 
 # ------------------------------
 # Helper Functions
@@ -93,6 +80,65 @@ def get_iv(S, K, R, T, mktprice, call: bool):
         iv_series[idx] = iv
     return iv_series
 
+def get_iv_vectorized(S, K, R, T, mktprice, call: bool, tol=1e-6, max_iter=100):
+    """
+    Array-at-once version of get_iv. All contracts are iterated together and each one
+    drops out of the active set once its own step is below tol.
+
+    Every element keeps a [low, high] bracket around the root (the model price is increasing
+    in sigma). Where vega collapses, or the Newton step would leave the bracket, the element
+    takes a bisection step instead, so deep in/out of the money contracts still converge
+    instead of stopping at the starting guess.
+
+    Accepts Series or arrays; returns a Series on the index of S when S has one.
+    """
+    epsilon = 1e-10
+    max_iv = 5
+    min_iv = 1e-4
+    index = S.index if hasattr(S, "index") else None
+    s, k, r, t, mp = (np.asarray(a, dtype=float) for a in (S, K, R, T, mktprice))
+    sign = 1.0 if call else -1.0
+
+    iv_out = np.full(s.shape, np.nan)
+    valid = (s > 0) & (k > 0) & (t > 0) & (mp > 0) & np.isfinite(r)
+    pos = np.flatnonzero(valid)
+    s, k, r, t, mp = s[pos], k[pos], r[pos], t[pos], mp[pos]
+    disc = np.exp(-r * t)
+    sqrt_t = np.sqrt(t)
+
+    iv = np.full(pos.size, 0.01)
+    low = np.full(pos.size, min_iv, dtype=float)
+    high = np.full(pos.size, max_iv, dtype=float)
+    active = np.arange(pos.size)
+    for _ in range(max_iter):
+        if active.size == 0:
+            break
+        a = active
+        sigma = iv[a]
+        d1 = bs_d1(s[a], k[a], t[a], r[a], sigma)
+        d2 = d1 - sigma * sqrt_t[a]
+        model_price = sign * disc[a] * (s[a] * norm.cdf(sign * d1) - k[a] * norm.cdf(sign * d2))
+        vega_val = s[a] * disc[a] * sqrt_t[a] * norm.pdf(d1)
+        diff = model_price - mp[a]
+
+        # Shrink the bracket around the root.
+        high[a] = np.where(diff > 0, sigma, high[a])
+        low[a] = np.where(diff <= 0, sigma, low[a])
+
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            newton = np.clip(sigma - diff / vega_val, min_iv, max_iv)
+        bisect = (vega_val < epsilon) | ~((newton >= low[a]) & (newton <= high[a]))
+        new_iv = np.where(bisect, 0.5 * (low[a] + high[a]), newton)
+
+        done = (np.abs(new_iv - sigma) < tol) | (high[a] - low[a] < tol) | (diff == 0)
+        iv[a] = np.where(diff == 0, sigma, new_iv)
+        active = a[~done]
+
+    iv_out[pos] = iv
+    if index is not None:
+        return pd.Series(iv_out, index=index)
+    return iv_out
+
 def get_rate_for_maturity(row_rates, maturity, mapping):
     """
     For a given maturity (in days), attempt to retrieve the rate from row_rates using the mapping.
@@ -175,45 +221,8 @@ def calculate_pv_alldivs(df, rates_df, country):
 
     df = df.sort_values("Date").copy()
 
-    # Define the mapping dictionary for the given country.
-    if country.upper() == "NORWAY":
-        mapping = {
-            1: "NOKONZ=R",
-            7: "OINOKSWD=",
-            30: "OINOK1MD=",
-            60: "OINOK2MD=",
-            90: "OINOK3MD=",
-            180: "OINOK6MD=",
-            270: "NOK9MZ=R",
-            365: "NOK1YZ=R",
-            455: "NOK1Y3MZ=R"
-        }
-    elif country.upper() == "SWEDEN":
-        mapping = {
-            1: "STISEKTNDFI=",
-            7: "STISEK1WDFI=",
-            30: "STISEK1MDFI=",
-            60: "STISEK2MDFI=",
-            90: "STISEK3MDFI=",
-            180: "STISEK6MDFI=",
-            270: "SEK9MZ=R",
-            365: "SEGOV1YZ=R",
-            455: "SEGOV1Y3MZ=R"
-        }
-    elif country.upper() == "DENMARK":
-        mapping = {
-            1: "DKKONZ=R",
-            7: "CIDKKSWD=",
-            30: "CIDKK1MD=",
-            60: "DKK2MZ=R",
-            90: "DKK9MZ=R",
-            180: "CIDKK6MD=",
-            270: "DKK9MZ=R",
-            365: "CIDKK1YD=",
-            455: "DKKABQCD1Y3MZ=R"
-        }
-    else:
-        raise ValueError("Country not recognized. Use 'NORWAY', 'SWEDEN', or 'DENMARK'.")
+    # Look up the tenor -> RIC mapping for the given country.
+    mapping = get_rate_mapping(country)
 
     # Extract dividend payment days (rows with nonzero dividend amounts).
     divs = df[df["ulying_div"] != 0][["Date", "ulying_div"]].copy()
@@ -260,96 +269,72 @@ def calculate_pv_alldivs(df, rates_df, country):
     df["PV_alldivs"] = pv_alldivs_list
     return df
 
+def calculate_pv_alldivs_vectorized(df, rates_df, country, curve=None):
+    """
+    Same result as calculate_pv_alldivs, computed in one pass instead of a nested iterrows.
 
-def get_risk_free_rate(maturities, country, dates):
-    rates = pd.read_csv('unprocessed_data/risk_free_rates2.csv', parse_dates=['Date'], index_col='Date')
-    if country == "NORWAY":
-        mapping = {
-            1: "NOKONZ=R",
-            7: "OINOKSWD=",
-            30: "OINOK1MD=",
-            60: "OINOK2MD=",
-            90: "OINOK3MD=",
-            180: "OINOK6MD=",
-            270: "NOK9MZ=R",
-            365: "NOK1YZ=R",
-            455: "NOK1Y3MZ=R"
-        }
-    elif country == "SWEDEN":
-        mapping = {
-            1: "STISEKTNDFI=",
-            7: "STISEK1WDFI=",
-            30: "STISEK1MDFI=",
-            60: "STISEK2MDFI=",
-            90: "STISEK3MDFI=",
-            180: "STISEK6MDFI=",
-            270: "SEK9MZ=R",
-            365: "SEGOV1YZ=R",
-            455: "SEGOV1Y3MZ=R"
-        }
-    elif country == "DENMARK":
-        mapping = {
-            1: "DKKONZ=R",
-            7: "CIDKKSWD=",
-            30: "CIDKK1MD=",
-            60: "DKK2MZ=R",
-            90: 'DKK9MZ=R',
-            180: "CIDKK6MD=",
-            270: "DKK9MZ=R",
-            365: "CIDKK1YD=",
-            455: "DKKABQCD1Y3MZ=R"
-        }
-    else:
-        print("country:", country)
-        raise ValueError("Country not recognized")
+    Dividend dates are sorted, so the dividends that fall strictly after a pricing day and
+    strictly before its expiry form a contiguous window that is found with searchsorted.
+    The rates row is looked up once per pricing day and all (pricing day, dividend) pairs
+    are discounted together. A prebuilt RateCurve can be passed instead of rates_df.
+    """
+    if "Date" not in df.columns:
+        df = df.reset_index()
+
+    df = df.sort_values("Date").copy()
+    if curve is None:
+        curve = RateCurve.from_frame(rates_df, country)
+
+    day = to_day_numbers(df["Date"])
+    dividend = df["ulying_div"].to_numpy(dtype=float)
+    div_mask = dividend != 0
+    div_day = day[div_mask].astype(float)
+    div_amount = dividend[div_mask]
+
+    # A dividend T_days (whole days) away is included when T_days < maturity * 365.
+    T_expiry = df["maturity"].to_numpy(dtype=float) * 365.0
+    cutoff = np.where(np.isnan(T_expiry), np.inf, np.ceil(T_expiry))
+    lo = np.searchsorted(div_day, day, side="right")
+    hi = np.maximum(np.searchsorted(div_day, day + cutoff, side="left"), lo)
+
+    # "asof" row of the rates for every pricing day; -1 when the day precedes all rates.
+    rate_pos = curve.positions(df["Date"])
+
+    # Expand every pricing day into its (pricing day, dividend) pairs.
+    counts = np.where(rate_pos >= 0, hi - lo, 0)
+    row = np.repeat(np.arange(len(df)), counts)
+    offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    div_idx = lo[row] + offset
+
+    T_days = div_day[div_idx] - day[row]
+    r_div = curve.rate_at(rate_pos[row], T_days)
+    discounted = np.where(np.isnan(r_div), 0.0, div_amount[div_idx] * np.exp(-r_div * (T_days / 365.0)))
+
+    df["PV_alldivs"] = np.bincount(row, weights=discounted, minlength=len(df))
+    return df
 
+
+def get_risk_free_rate(maturities, country, dates, curve=None):
+    """
+    Risk-free rate (in decimals) for each date, linearly interpolated at the option's
+    maturity (in years) on the country's tenor curve. Without a curve the process-wide
+    memory-mapped rate store is used, so risk_free_rates2.csv is not parsed per call.
+    """
+    if curve is None:
+        curve = get_rate_curve(country)
+    days = np.asarray(maturities, dtype=float) * 365
+    too_long = ~(days < curve.tenors[-1])
+    if too_long.any():
+        print("maturity of ", days[too_long][0], "too long")
+        raise ValueError("Maturity too long")
     dates_norm = dates.normalize()
-    rates = rates.reindex(dates_norm, method='ffill')
-    days = maturities * 365
-    interp_rates = []
-    for d, day in zip(dates_norm, days):
-        if day < 7:
-            keys = (mapping[1], mapping[7])
-            x_points = [0, 1]
-        elif day < 30:
-            keys = (mapping[7], mapping[30])
-            x_points = [7, 30]
-        elif day < 60:
-            keys = (mapping[30], mapping[60])
-            x_points = [30, 60]
-        elif day < 90:
-            keys = (mapping[60], mapping[90])
-            x_points = [60, 90]
-        elif day < 180:
-            keys = (mapping[90], mapping[180])
-            x_points = [90, 180]
-        elif day < 270:
-            keys = (mapping[180], mapping[270])
-            x_points = [180, 270]
-        elif day < 365:
-            keys = (mapping[270], mapping[365])
-            x_points = [270, 365]
-        elif day < 455:
-            keys = (mapping[365], mapping[455])
-            x_points = [365, 455]
-        else:
-            print("maturity of ", day, "too long")
-            raise ValueError("Maturity too long")
-        try:
-            r1 = rates.at[d, keys[0]]
-            r2 = rates.at[d, keys[1]]
-        except KeyError:
-            r1, r2 = np.nan, np.nan
-        interp_rate = np.interp(day, x_points, [r1, r2])
-        interp_rates.append(interp_rate)
-    interp_rates_series = pd.Series(interp_rates, index=dates_norm)
-    return interp_rates_series / 100.0
+    return pd.Series(curve.rate(dates_norm, days), index=dates_norm)
 
 # ------------------------------
 # Main Processing Loop
 # ------------------------------
 
-def process_option_group(i, options, rates_o):
+def process_option_group(i, options, rates_o=None):
     # Process one option group (columns i to i+8)
     nonzero_indices = [i+1, i+2, i+3, i+4, i+5, i+7]
     mask_zeros = (options.iloc[:, nonzero_indices] != 0).all(axis=1)
@@ -369,11 +354,13 @@ def process_option_group(i, options, rates_o):
 
     # Get country identifier from column information and add it as a new column.
     country = options.columns[i][2]
-    rates = get_risk_free_rate(maturity, country, filtered_options.index)
+    # Workers attach to the shared rate store unless a rates frame is passed explicitly.
+    curve = get_rate_curve(country) if rates_o is None else RateCurve.from_frame(rates_o, country)
+    rates = get_risk_free_rate(maturity, country, filtered_options.index, curve)
     call_moneyness = ulying_price / strike
     put_moneyness = strike / ulying_price
-    IV_put = get_iv(ulying_price, strike, rates, maturity, put_price, False)
-    IV_call = get_iv(ulying_price, strike, rates, maturity, call_price, True)
+    IV_put = get_iv_vectorized(ulying_price, strike, rates, maturity, put_price, False)
+    IV_call = get_iv_vectorized(ulying_price, strike, rates, maturity, call_price, True)
     eksp = -rates * maturity
     new_y = call_price - put_price
     new_x = ulying_price - (strike * np.exp(eksp))
@@ -402,23 +389,86 @@ def process_option_group(i, options, rates_o):
     reg_data['country'] = country
     print("getting all divs", ulying_price.name)
 
-    reg_data = calculate_pv_alldivs(reg_data, rates_o, country)
+    reg_data = calculate_pv_alldivs_vectorized(reg_data, rates_o, country, curve)
 
     reg_data['x'] = reg_data['x']-reg_data['PV_alldivs']
 
     return reg_data
 
-group_indices = list(range(0, len(options.columns), 9))
-results = Parallel(n_jobs=-1)(
-    delayed(process_option_group)(i, options, rates_o) for i in group_indices
-)
+def filter_option_group(group):
+    """
+    The rows of a 9-column group frame that process_option_group keeps. Filtering before
+    dispatch means a worker only ever receives the rows it will use.
+    """
+    required = group.iloc[:, [1, 2, 3, 4, 5, 7]]
+    return group[((required != 0) & required.notna()).all(axis=1)].copy()
 
-# Separate by country (filter out empty DataFrames, if any)
-linreg_dk = pd.concat([df for df in results if not df.empty and df['country'].iloc[0] == "DENMARK"])
-linreg_se = pd.concat([df for df in results if not df.empty and df['country'].iloc[0] == "SWEDEN"])
-linreg_no = pd.concat([df for df in results if not df.empty and df['country'].iloc[0] == "NORWAY"])
+def slice_option_group(options, i):
+    # A slice is all a worker needs, so the full wide frame never has to be pickled per task.
+    return filter_option_group(options.iloc[:, i:i + 9])
 
+def process_option_batch(groups, rates_o=None):
+    # Each group frame holds only its own 9 columns, so its group index is 0.
+    return [process_option_group(0, group, rates_o) for group in groups]
 
-linreg_dk.to_csv('processed_data/dk_processed_data.csv', index=False)
-linreg_se.to_csv('processed_data/se_processed_data.csv', index=False)
-linreg_no.to_csv('processed_data/no_processed_data.csv', index=False)
+def run_group_frames(groups, n_jobs=-1, backend="loky", batch_size=8, rates_o=None):
+    """
+    Runs process_option_group over an iterable of 9-column group frames.
+
+    Groups are filtered in the parent and sent batch_size at a time, so a task carries only
+    its own columns and rows and the per-task overhead is shared by several groups. The
+    iterable is consumed lazily as joblib dispatches, so at most a few batches are held
+    in memory.
+    """
+    def batches():
+        batch = []
+        for group in groups:
+            batch.append(filter_option_group(group))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    results = Parallel(n_jobs=n_jobs, backend=backend)(
+        delayed(process_option_batch)(batch, rates_o) for batch in batches()
+    )
+    return [df for batch in results for df in batch]
+
+def run_option_groups(options, n_jobs=-1, backend="loky", batch_size=8, rates_o=None):
+    """run_group_frames over every 9-column group of the wide options frame."""
+    groups = (options.iloc[:, i:i + 9] for i in range(0, len(options.columns), 9))
+    return run_group_frames(groups, n_jobs, backend, batch_size, rates_o)
+
+if __name__ == "__main__":
+    # ------------------------------
+    # Read Data and Prepare Options
+    # ------------------------------
+
+    # Parse the risk-free rates once into the memory-mapped store the workers attach to
+    build_rate_store()
+    # Convert kovadata3.csv to the long column store (only when the CSV has changed)
+    # and stream the option groups out of it
+    build_options_store()
+    results = run_group_frames(iter_group_frames(), n_jobs=-1, backend="loky", batch_size=8)
+    # The contract id is the group's position in kovadata3; data5 and the backtest group on it
+    results = [df.assign(contract=g) for g, df in enumerate(results)]
+
+    # Separate by country (filter out empty DataFrames, if any)
+    linreg_dk = pd.concat([df for df in results if not df.empty and df['country'].iloc[0] == "DENMARK"])
+    linreg_se = pd.concat([df for df in results if not df.empty and df['country'].iloc[0] == "SWEDEN"])
+    linreg_no = pd.concat([df for df in results if not df.empty and df['country'].iloc[0] == "NORWAY"])
+
+
+    # Early exercise premiums for the whole country frame in one batched solve; this
+    # replaces running calculate_eeps on the exported CSVs afterwards. "surface" and "baw"
+    # (see eep.EEP_METHODS) are faster approximations of the default "fd".
+    eep_method = DEFAULT_EEP_METHOD
+    linreg_dk = add_eep(linreg_dk, method=eep_method)
+    linreg_se = add_eep(linreg_se, method=eep_method)
+    linreg_no = add_eep(linreg_no, method=eep_method)
+
+    # No CSV is exported: calculate_eeps would add the premium to x a second time
+    write_frame(linreg_dk, 'dk_processed_data')
+    write_frame(linreg_se, 'se_processed_data')
+    write_frame(linreg_no, 'no_processed_data')
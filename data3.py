@@ -1,42 +1,207 @@
+import os
+
 import pandas as pd
 import numpy as np
 
+from frame_io import write_frame, read_frame, iter_frame
+from timeseries import SERIES_DB_PATH, SeriesStore, import_csv_once
+
 # ------------------------------
 # Exchange Rates Adjustments
 # ------------------------------
-#
-linreg_dk = pd.read_csv("processed_data/dk_processed_data.csv", parse_dates=['Date'], index_col='Date')
-linreg_no = pd.read_csv("processed_data/no_processed_data.csv", parse_dates=['Date'], index_col='Date')
-linreg_se = pd.read_csv("processed_data/se_processed_data.csv", parse_dates=['Date'], index_col='Date')
 
-linreg_dk = linreg_dk.rename(columns={'eep_call': 'EEP_call', 'eep_put': 'EEP_put'})
-linreg_no = linreg_no.rename(columns={'eep_call': 'EEP_call', 'eep_put': 'EEP_put'})
-linreg_se = linreg_se.rename(columns={'eep_call': 'EEP_call', 'eep_put': 'EEP_put'})
+columns_to_multiply = ['y', 'x','PV_alldivs','strike','call_price', 'put_price', 'ulying_price',
+    'EEP_call', 'EEP_put']
 
-# Read and prepare exchange rates with dates parsed and set as index
-exchange_rates = pd.read_csv("unprocessed_data/exchange_rates.csv", parse_dates=['Date'], index_col='Date')
+BASE_CURRENCY = 'SEK'
+FX_INDEX_PATH = "processed_data/fx_index.npz"
+EXCHANGE_RATES_PATH = "unprocessed_data/exchange_rates.csv"
 
-# Reindex the exchange rate series to match the dates in the country-specific DataFrames
-dk_exchange = exchange_rates['SEKDKK=X'].reindex(linreg_dk.index, method='ffill')
-no_exchange = exchange_rates['SEKNOK=X'].reindex(linreg_no.index, method='ffill')
+# Currency of each market's prices, and the exchange_rates.csv column giving the SEK price of
+# one unit of each currency. A new market needs an entry in both (and its pair in
+# get_exchangerates.py); conversions between any two currencies go through SEK.
+COUNTRY_CURRENCY = {'DENMARK': 'DKK', 'NORWAY': 'NOK', 'SWEDEN': 'SEK'}
+CURRENCY_RATES = {'DKK': 'SEKDKK=X', 'NOK': 'SEKNOK=X'}
 
-columns_to_multiply = ['y', 'x','PV_alldivs','strike','call_price', 'put_price', 'ulying_price',
-    'EEP_call', 'EEP_put']
-linreg_dk[columns_to_multiply] = linreg_dk[columns_to_multiply].multiply(dk_exchange, axis=0)
-linreg_no[columns_to_multiply] = linreg_no[columns_to_multiply].multiply(no_exchange, axis=0)
+# Exchange rate column that converts each country's currency to SEK.
+SEK_RATES = {country: CURRENCY_RATES[currency] for country, currency in COUNTRY_CURRENCY.items()
+    if currency in CURRENCY_RATES}
 
-# Combine all country data (Sweden remains unchanged)
-linreg_gen = pd.concat([linreg_dk, linreg_se, linreg_no])
-linreg_gen.sort_index(inplace=True)
-# Reset index so that Date becomes a column
-linreg_gen = linreg_gen.reset_index()
 
+def _days(dates):
+    return np.asarray(pd.to_datetime(np.asarray(dates)), dtype='datetime64[D]').astype(np.int64)
 
-linreg_gen['Date'] = pd.to_datetime(linreg_gen['Date'])
 
+class FXIndex:
+    """
+    Daily SEK rates of every currency, forward filled onto one row per calendar day from
+    the first exchange rate date, so the rate of any date is an array lookup at
+    (date - first day). Dates before the first rate get NaN, dates after the last one the
+    last rate, like reindex(method='ffill').
+    """
 
-# ------------------------------
-# Save the Final DataFrame
-# ------------------------------
+    def __init__(self, first_day, currencies, rates):
+        self.first_day = int(first_day)
+        self.currencies = list(currencies)
+        self.rates = rates
+        self.column = {currency: i for i, currency in enumerate(self.currencies)}
+
+    @classmethod
+    def build(cls, exchange_rates, currency_rates=None):
+        """From read_exchange_rates' frame; a missing quote keeps the previous day's rate."""
+        currency_rates = CURRENCY_RATES if currency_rates is None else currency_rates
+        exchange_rates = exchange_rates.sort_index()
+        rate_days = _days(exchange_rates.index)
+        days = np.arange(rate_days[0], rate_days[-1] + 1)
+        row = np.searchsorted(rate_days, days, side='right') - 1
+        currencies = [BASE_CURRENCY, *currency_rates]
+        rates = np.ones((len(days), len(currencies)))
+        for i, currency in enumerate(currencies[1:], start=1):
+            rates[:, i] = exchange_rates[currency_rates[currency]].ffill().to_numpy()[row]
+        return cls(rate_days[0], currencies, rates)
+
+    def save(self, path=FX_INDEX_PATH, version=""):
+        """version identifies the exchange rates the index was built from (see fx_version)."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez(path, first_day=self.first_day, currencies=np.array(self.currencies), rates=self.rates,
+            version=np.array(version))
+
+    @staticmethod
+    def saved_version(path=FX_INDEX_PATH):
+        with np.load(path) as f:
+            return str(f['version']) if 'version' in f.files else None
+
+    @classmethod
+    def load(cls, path=FX_INDEX_PATH):
+        with np.load(path) as f:
+            return cls(int(f['first_day']), f['currencies'].tolist(), f['rates'])
+
+    def factor(self, dates, currency, to_currency=BASE_CURRENCY):
+        """Per date, the price in to_currency of one unit of currency."""
+        if currency == to_currency:
+            return np.ones(len(dates))
+        idx = _days(dates) - self.first_day
+        before = idx < 0
+        idx = np.clip(idx, 0, len(self.rates) - 1)
+        factor = self.rates[idx, self.column[currency]] / self.rates[idx, self.column[to_currency]]
+        factor[before] = np.nan
+        return factor
+
+    def country_factor(self, dates, country, to_currency=BASE_CURRENCY):
+        return self.factor(dates, COUNTRY_CURRENCY[country.upper()], to_currency)
+
+    def scaler(self, country, to_currency=BASE_CURRENCY):
+        """
+        A function of a chunk with a Date column returning its conversion factors, e.g. the
+        scale argument of regression.accumulate_frame.
+        """
+        return lambda chunk: self.country_factor(chunk['Date'], country, to_currency)
+
+    def convert(self, df, country, to_currency=BASE_CURRENCY, columns=None):
+        """
+        A new frame: df (with a Date column or index) with its money columns converted. df
+        itself is left unchanged.
+        """
+        dates = df['Date'] if 'Date' in df.columns else df.index
+        factor = self.country_factor(dates, country, to_currency)
+        money = [c for c in (columns_to_multiply if columns is None else columns) if c in df.columns]
+        return df.assign(**{c: df[c].to_numpy() * factor for c in money})
+
+
+# FXIndex per path, loaded once per process.
+_fx_indexes = {}
+
+def fx_version(rates_path=EXCHANGE_RATES_PATH, db_path=SERIES_DB_PATH):
+    """Changes whenever the stored exchange rates do."""
+    import_csv_once(rates_path, db_path)
+    with SeriesStore(db_path) as store:
+        return store.version(CURRENCY_RATES.values())
+
+def build_fx_index(path=FX_INDEX_PATH, rates_path=EXCHANGE_RATES_PATH, force=False, db_path=SERIES_DB_PATH):
+    """Builds and saves the index unless path was built from the current exchange rates."""
+    version = fx_version(rates_path, db_path)
+    if force or not os.path.exists(path) or FXIndex.saved_version(path) != version:
+        FXIndex.build(read_exchange_rates(rates_path, db_path)).save(path, version)
+        _fx_indexes.pop(path, None)
+    return path
+
+def get_fx_index(path=FX_INDEX_PATH, rates_path=EXCHANGE_RATES_PATH):
+    """The process' FXIndex for path, (re)built first if the exchange rates changed."""
+    if path not in _fx_indexes:
+        build_fx_index(path, rates_path)
+        _fx_indexes[path] = FXIndex.load(path)
+    return _fx_indexes[path]
+
+def read_converted(name, country, columns=None, to_currency=BASE_CURRENCY, fx=None):
+    """read_frame of a country frame with its money columns in to_currency."""
+    fx = get_fx_index() if fx is None else fx
+    read_columns = None if columns is None else list(dict.fromkeys([*columns, 'Date']))
+    df = fx.convert(read_frame(name, columns=read_columns), country, to_currency)
+    return df if columns is None else df[list(columns)]
+
+def iter_converted(frames, columns=None, to_currency=BASE_CURRENCY, fx=None, chunk_size=1_000_000):
+    """
+    The rows of several country frames, {country: frame name}, in to_currency, chunk_size
+    rows at a time and one frame after the other: the pooled data without a pooled frame.
+    """
+    fx = get_fx_index() if fx is None else fx
+    read_columns = None if columns is None else list(dict.fromkeys([*columns, 'Date']))
+    for country, name in frames.items():
+        for chunk in iter_frame(name, columns=read_columns, chunk_size=chunk_size):
+            chunk = fx.convert(chunk, country, to_currency)
+            yield chunk if columns is None else chunk[list(columns)]
+
+def sek_factor(dates, country, exchange_rates):
+    """Factor that converts the country's prices on dates to SEK (1 for Sweden)."""
+    return FXIndex.build(exchange_rates).country_factor(dates, country)
+
+def convert_to_sek(linreg_dk, linreg_no, linreg_se, exchange_rates):
+    """
+    Converts the Danish and Norwegian frames (indexed by Date) to SEK and returns the
+    combined frame sorted by date, with Date as a column. Consumers of SEK data should use
+    read_converted or iter_converted instead, which never build the pooled frame.
+    """
+    fx = FXIndex.build(exchange_rates)
+    frames = []
+    for df, country in [(linreg_dk, 'DENMARK'), (linreg_se, 'SWEDEN'), (linreg_no, 'NORWAY')]:
+        df = df.rename(columns={'eep_call': 'EEP_call', 'eep_put': 'EEP_put'})
+        frames.append(fx.convert(df, country))
+
+    # Combine all country data (Sweden remains unchanged)
+    linreg_gen = pd.concat(frames)
+    linreg_gen.sort_index(inplace=True)
+    # Reset index so that Date becomes a column
+    linreg_gen = linreg_gen.reset_index()
+
+
+    linreg_gen['Date'] = pd.to_datetime(linreg_gen['Date'])
+    return linreg_gen
+
+def read_exchange_rates(path=EXCHANGE_RATES_PATH, db_path=SERIES_DB_PATH, known_at=None):
+    """
+    The exchange rates of CURRENCY_RATES, indexed by Date, from the series store;
+    exchange_rates.csv at path is imported into it first if it changed. known_at reads the
+    rates as they were stored at that time.
+    """
+    import_csv_once(path, db_path)
+    with SeriesStore(db_path) as store:
+        return store.frame(CURRENCY_RATES.values(), known_at)
+
+
+if __name__ == "__main__":
+    # This script used to write the pooled SEK frame gen_processed_data. It now builds the
+    # date -> exchange rate index that read_converted and iter_converted use instead, so the
+    # SEK data is converted when read. Set export_gen to also write gen_processed_data (as
+    # before: all countries in SEK, sorted by date, plus a CSV copy) for tools that need it.
+    export_gen = False
+
+    fx = FXIndex.load(build_fx_index(force=True))
+    frames = {'DENMARK': 'dk_processed_data', 'NORWAY': 'no_processed_data', 'SWEDEN': 'se_processed_data'}
+    for chunk in iter_converted(frames, columns=['Date', 'x', 'y'], fx=fx):
+        print(f"{len(chunk)} rows, {chunk['Date'].min():%Y-%m-%d} - {chunk['Date'].max():%Y-%m-%d}, "
+            f"mean x {chunk['x'].mean():.2f} SEK")
 
-linreg_gen.to_csv('processed_data/gen_processed_data.csv', index=False)
+    if export_gen:
+        linreg_gen = pd.concat(iter_converted(frames, fx=fx), ignore_index=True)
+        linreg_gen = linreg_gen.sort_values('Date', kind='stable', ignore_index=True)
+        write_frame(linreg_gen, 'gen_processed_data', csv_export=True)
@@ -4,6 +4,12 @@ import statsmodels.api as sm
 import matplotlib.pyplot as plt
 import statsmodels.formula.api as smf
 
+from data3 import get_fx_index
+from frame_io import read_frame
+from quantiles import QuantileSketch, iter_winsorized, sketch_errors, winsor_bounds
+from regression import OLSAccumulator, robust_errors, sweep_filters
+from render import density_spec, histogram_spec, render_figures
+
 def drop_low_volume(df, min_vol):
     df = df[df['call_v'] >= min_vol]
     df = df[df['put_v'] >= min_vol]
@@ -18,18 +24,26 @@ def dropilliquid(df, max_illiquidity):
     #df = df.dropna(subset=['ulying_illiquidity', 'call_illiquidity', 'put_illiquidity'])
     return df
 
-def winsorize_errors(df, winsor_pct=0.05):
+def winsorize_errors(df, winsor_pct=0.05, eps=0.0, chunk_size=1_000_000):
     """
     Calculate the error (y - x), then mark observations where the error
     is below the winsor_pct or above the (1 - winsor_pct) quantile.
     These observations are removed from the returned dataframe.
+    With eps > 0 the bounds come from a QuantileSketch fed chunk_size rows
+    at a time, with a rank error of about eps instead of exact quantiles.
     """
     # Calculate the error column
     df['error'] = df['y'] - df['x']
 
     # Compute the lower and upper quantile bounds
-    lower_bound = df['error'].quantile(winsor_pct)
-    upper_bound = df['error'].quantile(1 - winsor_pct)
+    if eps > 0:
+        sketch = QuantileSketch(eps, seed=0)
+        for start in range(0, len(df), chunk_size):
+            sketch.update(df['error'].to_numpy()[start:start + chunk_size])
+        lower_bound, upper_bound = winsor_bounds(sketch, winsor_pct)
+    else:
+        lower_bound = df['error'].quantile(winsor_pct)
+        upper_bound = df['error'].quantile(1 - winsor_pct)
 
     # Create a flag: 1 if error is outside the bounds, 0 otherwise
     df['winsor_flag'] = np.where((df['error'] < lower_bound) | (df['error'] > upper_bound), 1, 0)
@@ -38,187 +52,182 @@ def winsorize_errors(df, winsor_pct=0.05):
     df_filtered = df[df['winsor_flag'] == 0].copy()
     return df_filtered
 
+def streaming_fit(name, min_vol, winsor_pct, eps=0.001, chunk_size=1_000_000):
+    """
+    drop_low_volume + winsorize_errors + OLS without loading the frame: pass one sketches the
+    errors of the rows above min_vol, pass two feeds the rows within the sketch's bounds to an
+    OLSAccumulator. eps=0 gives the exact bounds (all errors are then held in memory).
+    """
+    columns = ['call_v', 'put_v', 'ulying_volume']
 
-linreg_dk = pd.read_csv('processed_data/dk_processed_data.csv')
-linreg_se = pd.read_csv('processed_data/se_processed_data.csv')
-linreg_no = pd.read_csv('processed_data/no_processed_data.csv')
-linreg_gen = pd.read_csv('processed_data/gen_processed_data.csv')
-
-
-min_vol = 10
-
-print("THE MINIMUM VOLUME IS:", min_vol)
-
-linreg_dk = drop_low_volume(linreg_dk, min_vol)
-linreg_se = drop_low_volume(linreg_se, min_vol)
-linreg_no = drop_low_volume(linreg_no, min_vol)
-linreg_gen = drop_low_volume(linreg_gen, min_vol)
-
-flag = False
-max_illiquidity = 0.15 #0,01 on pienin järkevä (tippuu liikaa sampleja pois sen alle),
-#0.15 on suurin järkevä ja tiputtaa about 10 pros kaikista havainnoista
-
-if flag:
-    linreg_dk = dropilliquid(linreg_dk, max_illiquidity)
-    linreg_se = dropilliquid(linreg_se, max_illiquidity)
-    linreg_no = dropilliquid(linreg_no, max_illiquidity)
-    linreg_gen = dropilliquid(linreg_gen, max_illiquidity)
-
-winsor_pct = 0.01  # This parameter controls the top and bottom percentage to drop
-linreg_dk = winsorize_errors(linreg_dk, winsor_pct)
-linreg_se = winsorize_errors(linreg_se, winsor_pct)
-linreg_no = winsorize_errors(linreg_no, winsor_pct)
-linreg_gen = winsorize_errors(linreg_gen, winsor_pct)
-
-count = 1
-
-if not linreg_dk.empty:
-    linreg_dk = linreg_dk.dropna(subset=['x', 'y'])
-
-    print("dk linreg:")
-    X_dk = pd.to_numeric(linreg_dk['x'], errors='coerce')
-    y_dk = pd.to_numeric(linreg_dk['y'], errors='coerce')
-
-    X_dk = sm.add_constant(X_dk)
-
-    model_dk = sm.OLS(y_dk, X_dk).fit()
-
-    print(model_dk.summary())
-
-    plt.figure(figsize=(6,4))
-    plt.tight_layout()
-    plt.scatter(linreg_dk['x'], linreg_dk['y'], label='Data')
-    x_dk_sorted = np.sort(linreg_dk['x'])
-    y_dk_pred = model_dk.params[0] + model_dk.params[1] * x_dk_sorted
-    plt.plot(x_dk_sorted, y_dk_pred, color='red', label='Fit')
-    plt.plot(x_dk_sorted, x_dk_sorted, '--', color='gray', label='y = x')
-    plt.title("Denmark")
-    plt.xlabel("Stock position value, DKK")
-    plt.ylabel("Synthetic stock position value, DKK")
-    plt.legend()
-    plt.show()
-    #plt.savefig(f"käyrät/winzorisoitu/plot{count}.png", dpi=600)
-    plt.close()
-    count += 1
-
-if not linreg_se.empty:
-    linreg_se = linreg_se.dropna(subset=['x', 'y'])
-    linreg_se['x'] = linreg_se['x']
-
-    print("se linreg")
-    X_se = pd.to_numeric(linreg_se['x'], errors='coerce')
-    y_se = pd.to_numeric(linreg_se['y'], errors='coerce')
-
-    X_se = sm.add_constant(X_se)
-
-    model_se = sm.OLS(y_se, X_se).fit()
-
-    print(model_se.summary())
-
-    plt.figure(figsize=(6,4))
-    plt.tight_layout()
-    plt.scatter(linreg_se['x'], linreg_se['y'], label='Data')
-    x_se_sorted = np.sort(linreg_se['x'])
-    y_se_pred = model_se.params[0] + model_se.params[1] * x_se_sorted
-    plt.plot(x_se_sorted, y_se_pred, color='red', label='Fit')
-    plt.plot(x_se_sorted, x_se_sorted, '--', color='gray', label='y = x')
-    plt.title("Sweden")
-    plt.xlabel("Stock position value, SEK")
-    plt.ylabel("Synthetic stock position value, SEK")
-    plt.legend()
-    plt.show()
-    #plt.savefig(f"käyrät/winzorisoitu/plot{count}.png", dpi=600)
-    plt.close()
-    count += 1
-
-
-if not linreg_no.empty:
-    linreg_no = linreg_no.dropna(subset=['x', 'y'])
-
-    print("no linreg")
-    X_no = pd.to_numeric(linreg_no['x'], errors='coerce')
-    y_no = pd.to_numeric(linreg_no['y'], errors='coerce')
-
-    X_no = sm.add_constant(X_no)
+    def liquid(chunk):
+        return (chunk[columns] >= min_vol).all(axis=1)
 
-    model_no = sm.OLS(y_no, X_no).fit()
+    sketch = sketch_errors(name, liquid, columns, eps, chunk_size)
+    lower, upper = winsor_bounds(sketch, winsor_pct)
+    acc = OLSAccumulator()
+    for chunk in iter_winsorized(name, lower, upper, liquid, columns, chunk_size):
+        acc.update(chunk['x'], chunk['y'])
+    return acc
 
-    print(model_no.summary())
 
+def plot_fit(x, y, model, title, currency, color='red'):
     plt.figure(figsize=(6,4))
     plt.tight_layout()
-    plt.scatter(linreg_no['x'], linreg_no['y'], label='Data')
-    x_no_sorted = np.sort(linreg_no['x'])
-    y_no_pred = model_no.params[0] + model_no.params[1] * x_no_sorted
-    plt.plot(x_no_sorted, y_no_pred, color='red', label='Fit')
-    plt.plot(x_no_sorted, x_no_sorted, '--', color='gray', label='y = x')
-    plt.title("Norway")
-    plt.xlabel("Stock position value, NOK")
-    plt.ylabel("Synthetic stock position value, NOK")
+    plt.scatter(x, y, label='Data')
+    x_sorted = np.sort(x)
+    y_pred = model.params[0] + model.params[1] * x_sorted
+    plt.plot(x_sorted, y_pred, color=color, label='Fit')
+    plt.plot(x_sorted, x_sorted, '--', color='gray', label='y = x')
+    plt.title(title)
+    plt.xlabel(f"Stock position value, {currency}")
+    plt.ylabel(f"Synthetic stock position value, {currency}")
     plt.legend()
     plt.show()
-    #plt.savefig(f"käyrät/winzorisoitu/plot{count}.png", dpi=600)
+    #plt.savefig(f"käyrät/winzorisoitu/plot_{title}.png", dpi=600)
     plt.close()
-    count += 1
-
-
-X_gen = pd.to_numeric(linreg_gen['x'].dropna(), errors='coerce')
-y_gen = pd.to_numeric(linreg_gen['y'].dropna(), errors='coerce')
-
-X_gen = sm.add_constant(X_gen)
-
-model_gen = sm.OLS(y_gen, X_gen).fit()
-
-print(model_gen.summary())
 
-plt.figure(figsize=(6,4))
-plt.tight_layout()
-plt.scatter(linreg_gen['x'], linreg_gen['y'], label='Data')
-x_gen_sorted = np.sort(linreg_gen['x'])
-y_gen_pred = model_gen.params[0] + model_gen.params[1] * x_gen_sorted
-plt.plot(x_gen_sorted, y_gen_pred, color='green', label='Fit')
-plt.plot(x_gen_sorted, x_gen_sorted, '--', color='gray', label='y = x')
-plt.title("General Linear Regression")
-plt.xlabel("Stock position value, SEK")
-plt.ylabel("Synthetic stock position value, SEK")
-plt.legend()
-plt.show()
-#plt.savefig(f"käyrät/winzorisoitu/plot{count}.png", dpi=600)
-#plt.close()
-count += 1
-
-bins = 60
-# Create histograms for error distributions (y - x) for each country
-
-if not linreg_dk.empty:
-    plt.figure(figsize=(6,4))
-    plt.hist(linreg_dk['y'] - linreg_dk['x'], bins=bins, edgecolor='black')
-    plt.title("Error Distribution for Denmark")
-    plt.xlabel("Error (y - x)")
-    plt.ylabel("Frequency")
-    plt.yscale('log')
-    plt.tight_layout()
-    #plt.savefig("käyrät/winzorisoitu/histlog_denmark.png", dpi=600)
-    plt.close()
-
-if not linreg_se.empty:
-    plt.figure(figsize=(6,4))
-    plt.hist(linreg_se['y'] - linreg_se['x'], bins=bins, edgecolor='black')
-    plt.title("Error Distribution for Sweden")
-    plt.xlabel("Error (y - x)")
-    plt.ylabel("Frequency")
-    plt.yscale('log')
-    plt.tight_layout()
-    #plt.savefig("käyrät/winzorisoitu/histlog_sweden.png", dpi=600)
-    plt.close()
-
-if not linreg_no.empty:
-    plt.figure(figsize=(6,4))
-    plt.hist(linreg_no['y'] - linreg_no['x'], bins=bins, edgecolor='black')
-    plt.title("Error Distribution for Norway")
-    plt.xlabel("Error (y - x)")
-    plt.ylabel("Frequency")
-    plt.yscale('log')
-    plt.tight_layout()
-    #plt.savefig("käyrät/winzorisoitu/histlog_norway.png", dpi=600)
-    plt.close()
+def fit_spec(x, y, model, title, currency, path, color='red'):
+    """plot_fit as a density figure for render_figures."""
+    return density_spec(x, y, path, title, f"Stock position value, {currency}",
+        f"Synthetic stock position value, {currency}",
+        lines=[(model.params[0], model.params[1], color, 'Fit', '-'), (0.0, 1.0, 'gray', 'y = x', '--')])
+
+def print_fit(model):
+    print(f"No. Observations: {model.n}    R-squared: {model.rsquared:.4f}")
+    print(model.summary().to_string())
+
+
+if __name__ == "__main__":
+    linreg_dk = read_frame('dk_processed_data')
+    linreg_se = read_frame('se_processed_data')
+    linreg_no = read_frame('no_processed_data')
+
+    # Robustness check: the regressions over a grid of filter thresholds, from the frames
+    # loaded above, written to filter_sweep.json
+    sweep = False
+    if sweep:
+        sweep_min_vols = [0, 1, 5, 10, 20, 50, 100]
+        sweep_winsor_pcts = [0.0, 0.005, 0.01, 0.025, 0.05]
+        # None skips dropilliquid; add levels such as 0.05 or 0.15 when the illiquidity
+        # columns are present
+        sweep_illiquidities = [None]
+        sweep_table = pd.concat([
+            sweep_filters(df, sweep_min_vols, sweep_winsor_pcts, sweep_illiquidities).assign(country=country)
+            for df, country in [(linreg_dk, "DENMARK"), (linreg_se, "SWEDEN"), (linreg_no, "NORWAY")]
+        ], ignore_index=True)
+        print(sweep_table.to_string(index=False))
+        sweep_table.to_json("filter_sweep.json", orient="records", indent=1)
+
+
+    min_vol = 10
+
+    print("THE MINIMUM VOLUME IS:", min_vol)
+
+    linreg_dk = drop_low_volume(linreg_dk, min_vol)
+    linreg_se = drop_low_volume(linreg_se, min_vol)
+    linreg_no = drop_low_volume(linreg_no, min_vol)
+
+    flag = False
+    max_illiquidity = 0.15 #0,01 on pienin järkevä (tippuu liikaa sampleja pois sen alle),
+    #0.15 on suurin järkevä ja tiputtaa about 10 pros kaikista havainnoista
+
+    if flag:
+        linreg_dk = dropilliquid(linreg_dk, max_illiquidity)
+        linreg_se = dropilliquid(linreg_se, max_illiquidity)
+        linreg_no = dropilliquid(linreg_no, max_illiquidity)
+
+    winsor_pct = 0.01  # This parameter controls the top and bottom percentage to drop
+    linreg_dk = winsorize_errors(linreg_dk, winsor_pct)
+    linreg_se = winsorize_errors(linreg_se, winsor_pct)
+    linreg_no = winsorize_errors(linreg_no, winsor_pct)
+
+    # Per-country regressions from OLS accumulators. The pooled (SEK) regression merges
+    # the per-country accumulators of the SEK-converted rows, so gen_processed_data is
+    # not needed here.
+    fx = get_fx_index()
+    n_bootstrap = 1000
+    # With a directory, the fits and histograms are written there as density plots by
+    # render_figures instead of being shown one by one
+    render_dir = None  # e.g. "käyrät/winzorisoitu"
+    specs = []
+    pooled = OLSAccumulator()
+    pooled_x, pooled_y = [], []
+    countries = [
+        (linreg_dk, "DENMARK", "Denmark", "DKK"),
+        (linreg_se, "SWEDEN", "Sweden", "SEK"),
+        (linreg_no, "NORWAY", "Norway", "NOK"),
+    ]
+    for df, country, title, currency in countries:
+        if df.empty:
+            continue
+        df = df.dropna(subset=['x', 'y'])
+
+        print(f"{title} linreg:")
+        model = OLSAccumulator.from_arrays(df['x'], df['y'])
+        print_fit(model)
+        # Date-clustered, Driscoll-Kraay and date block bootstrap standard errors
+        print(robust_errors(df, n_resamples=n_bootstrap, block_length=5, seed=0).to_string())
+        if render_dir:
+            specs.append(fit_spec(df['x'], df['y'], model, title, currency,
+                f"{render_dir}/plot_{title}.png"))
+        else:
+            plot_fit(df['x'], df['y'], model, title, currency)
+
+        sek = fx.country_factor(df['Date'], country)
+        pooled = pooled + OLSAccumulator.from_arrays(df['x'] * sek, df['y'] * sek)
+        pooled_x.append(df['x'].to_numpy() * sek)
+        pooled_y.append(df['y'].to_numpy() * sek)
+
+    print("General linreg (SEK):")
+    print_fit(pooled)
+    if render_dir:
+        specs.append(fit_spec(np.concatenate(pooled_x), np.concatenate(pooled_y), pooled,
+            "General Linear Regression", "SEK", f"{render_dir}/plot_General Linear Regression.png",
+            color='green'))
+    else:
+        plot_fit(np.concatenate(pooled_x), np.concatenate(pooled_y), pooled,
+            "General Linear Regression", "SEK", color='green')
+
+    bins = 60
+    # Create histograms for error distributions (y - x) for each country
+
+    if render_dir:
+        for df, name in [(linreg_dk, "denmark"), (linreg_se, "sweden"), (linreg_no, "norway")]:
+            if not df.empty:
+                specs.append(histogram_spec(df['y'] - df['x'], f"{render_dir}/histlog_{name}.png",
+                    f"Error Distribution for {name.capitalize()}", "Error (y - x)", bins=bins))
+        render_figures(specs, render_dir)
+    else:
+        if not linreg_dk.empty:
+            plt.figure(figsize=(6,4))
+            plt.hist(linreg_dk['y'] - linreg_dk['x'], bins=bins, edgecolor='black')
+            plt.title("Error Distribution for Denmark")
+            plt.xlabel("Error (y - x)")
+            plt.ylabel("Frequency")
+            plt.yscale('log')
+            plt.tight_layout()
+            #plt.savefig("käyrät/winzorisoitu/histlog_denmark.png", dpi=600)
+            plt.close()
+
+        if not linreg_se.empty:
+            plt.figure(figsize=(6,4))
+            plt.hist(linreg_se['y'] - linreg_se['x'], bins=bins, edgecolor='black')
+            plt.title("Error Distribution for Sweden")
+            plt.xlabel("Error (y - x)")
+            plt.ylabel("Frequency")
+            plt.yscale('log')
+            plt.tight_layout()
+            #plt.savefig("käyrät/winzorisoitu/histlog_sweden.png", dpi=600)
+            plt.close()
+
+        if not linreg_no.empty:
+            plt.figure(figsize=(6,4))
+            plt.hist(linreg_no['y'] - linreg_no['x'], bins=bins, edgecolor='black')
+            plt.title("Error Distribution for Norway")
+            plt.xlabel("Error (y - x)")
+            plt.ylabel("Frequency")
+            plt.yscale('log')
+            plt.tight_layout()
+            #plt.savefig("käyrät/winzorisoitu/histlog_norway.png", dpi=600)
+            plt.close()
@@ -1,6 +1,10 @@
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+from joblib import Parallel, delayed
+
+from frame_io import read_frame
+from render import bar_spec, render_figures
 
 """EX ANTE ANALYYSI"""
 
@@ -42,6 +46,33 @@ def compute_lagged_profit(row, fees):
     # Choose the alternative with the higher profit, if positive; otherwise, no trade.
     return max(profit_hedge, profit_close)
 
+def contract_series(data):
+    """
+    Id of the contract series (one strike/maturity column group of kovadata3) of every row,
+    from the contract column data2 writes.
+    """
+    if 'contract' not in data.columns:
+        raise ValueError("The frame has no contract column; rerun data2 to write it.")
+    return data['contract']
+
+def lagged_profit(data, fees):
+    """
+    compute_lagged_profit for every row at once. The next observation is the next row of the
+    same contract series; the last row of a series has none and gets NaN.
+    """
+    series = contract_series(data)
+    x, y = data['x'], data['y']
+    x_next = x.groupby(series).shift(-1)
+    y_next = y.groupby(series).shift(-1)
+    error = y - x
+    long_x = error > 0
+    # Long x: hedge by shorting y next day or sell x. Long y: hedge by shorting x or sell y.
+    profit_hedge = np.where(long_x, y_next - x, x_next - y) - fees
+    profit_close = np.where(long_x, x_next - x, y_next - y) - fees
+    # Same pick as max(profit_hedge, profit_close), NaN handling included.
+    best = np.where(profit_close > profit_hedge, profit_close, profit_hedge)
+    return pd.Series(np.where(error.abs() <= fees, 0.0, best), index=data.index)
+
 def simulate_trade(data, divs:bool, fees:float, lag:bool):
     if not divs:
         data['x'] = data['x'] + data['PV_alldivs']
@@ -59,146 +90,229 @@ def simulate_trade(data, divs:bool, fees:float, lag:bool):
         data['returns'] = data['profit'] / data['capital_per_trade']
     else:
         data['error'] = data['y'] - data['x']
-        data['x_next'] = data['x'].shift(-1)
-        data['y_next'] = data['y'].shift(-1)
-        data['lagged_profit'] = data.apply(lambda row: compute_lagged_profit(row, fees), axis=1)
+        data['lagged_profit'] = lagged_profit(data, fees)
         vol_columns = ['call_v', 'put_v', 'ulying_volume']
         data['max_lagged_trade_count'] = data[vol_columns].min(axis=1) * 0.1
-        data.drop(columns=['x_next', 'y_next'], inplace=True)
         data['trade_count'] = data['max_lagged_trade_count'].astype(int).where(data['lagged_profit'] != 0, 0)
         data['total_profit'] = (data['lagged_profit'] * data['max_lagged_trade_count']).where(data['lagged_profit'] != 0)
         data['capital_per_trade'] = data['x'].abs() + data['y'].abs()
         data['returns'] = (data['lagged_profit'] / data['capital_per_trade']).where(data['lagged_profit'] != 0)
     return data
 
-def wf(data, filename, id):
-    with open(filename, 'a') as f:
-        f.write(f"Scenario {id}\n")
-        f.write("Total profit\n")
-        f.write((data['total_profit'].describe()).to_string())
-        f.write("\n\n")
-        f.write(f"{id} total profit: {data['total_profit'].sum()}\n")
-        f.write("\n")
-        f.write("Returns\n")
-        f.write((data['returns'].describe()).to_string())
-        f.write("\n\n")
-        f.write("------------------------------------------------")
-        f.write("\n\n")
-        f.close()
-
-def wrapper(datas:list, low_fees:list, high_fees:list, countries:list):
-    filename = "output.txt"
+# (id, agent knows the dividends, fee level, lag) of every scenario. The fee level is
+# "none", "low" or "high" (the country's fee) or a number; adding a scenario here costs
+# compute only, every dataset is still read once.
+SCENARIOS = [
+    ("1A", False, "none", False),
+    ("1B", True, "none", False),
+    ("2A", False, "low", False),
+    # As in the original script, 2B runs without the dividends despite its description.
+    ("2B", False, "low", False),
+    ("3A", False, "low", True),
+    ("3B", True, "low", True),
+    ("4A", False, "high", False),
+    ("4B", True, "high", False),
+    ("5A", False, "high", True),
+    ("5B", True, "high", True),
+]
+
+# The columns simulate_trade reads; everything else is left out when a dataset is loaded.
+TRADE_COLUMNS = ['y', 'x', 'call_v', 'put_v', 'ulying_volume', 'strike', 'maturity', 'PV_alldivs',
+    'contract']
+
+def format_scenario(data, id):
+    """The report text of one scenario."""
+    return (f"Scenario {id}\n"
+        "Total profit\n"
+        f"{data['total_profit'].describe().to_string()}\n\n"
+        f"{id} total profit: {data['total_profit'].sum()}\n\n"
+        "Returns\n"
+        f"{data['returns'].describe().to_string()}\n\n"
+        "------------------------------------------------\n\n")
+
+def summarize_scenario(data):
+    """Row of the structured results table for one simulate_trade result."""
+    profit_column = 'lagged_profit' if 'lagged_profit' in data.columns else 'profit'
+    summary = {
+        'trades': int((data['trade_count'] > 0).sum()),
+        'total_profit': float(data['total_profit'].sum()),
+        'mean_profit': float(data[profit_column].mean()),
+    }
+    for name, column in (('total_profit', data['total_profit']), ('returns', data['returns'])):
+        for stat, value in column.describe().items():
+            summary[f"{name}_{stat}"] = float(value)
+    return summary
+
+def run_scenario(data, divs, fee, lag):
+    # simulate_trade modifies its input, so every scenario gets its own copy.
+    return simulate_trade(data.copy(), divs, fee, lag)
+
+def run_scenarios(data, scenarios, fee_levels, n_jobs=1):
+    """
+    Runs simulate_trade for every (id, divs, fee, lag) in scenarios on one loaded dataset.
+    fee_levels maps fee level names to fees. With n_jobs other than 1 the scenarios run in
+    parallel with joblib. Returns {id: result frame} in scenario order.
+    """
+    jobs = [(id, divs, fee_levels.get(fee, fee), lag) for id, divs, fee, lag in scenarios]
+    if n_jobs == 1:
+        results = [run_scenario(data, divs, fee, lag) for _, divs, fee, lag in jobs]
+    else:
+        results = Parallel(n_jobs=n_jobs)(
+            delayed(run_scenario)(data, divs, fee, lag) for _, divs, fee, lag in jobs)
+    return {job[0]: result for job, result in zip(jobs, results)}
+
+def wrapper(datas:list, low_fees:list, high_fees:list, countries:list, scenarios=SCENARIOS,
+        n_jobs=1, filename="output.txt", results_path="scenario_results.json"):
+    """
+    Runs every scenario for every country, reading each dataset (a processed frame name, see
+    frame_io.read_frame) once. Writes the text report to filename and one row per
+    (country, scenario) to results_path as JSON records.
+    """
+    report = []
+    rows = []
+    for name, low_fee, high_fee, country in zip(datas, low_fees, high_fees, countries):
+        report.append("\n\n------------------------------------------------\n\n"
+            f"Country: {country}\n\n\n")
+        data = read_frame(name, columns=TRADE_COLUMNS)
+        fee_levels = {'none': 0.0, 'low': low_fee, 'high': high_fee}
+        results = run_scenarios(data, scenarios, fee_levels, n_jobs)
+        for id, divs, fee, lag in scenarios:
+            report.append(format_scenario(results[id], id))
+            rows.append({'country': country, 'scenario': id, 'divs': divs,
+                'fee': float(fee_levels.get(fee, fee)), 'lag': lag,
+                **summarize_scenario(results[id])})
+
     with open(filename, "w") as f:
-        f.close()
-    for csv, low_fee, high_fee, country in zip(datas, low_fees, high_fees, countries):
-        with open(filename, "a") as f:
-            f.write("\n\n")
-            f.write("------------------------------------------------")
-            f.write("\n\n")
-            f.write(f"Country: {country}\n")
-            f.write("\n\n")
-            f.close()
-        #1A: Agentti ei tiedä osinkoja, ei kuluja
-        A1 = pd.read_csv(csv)
-        A1 = A1.drop(columns=['Date', 'put_moneyness', 'call_moneyness',
-            'IV_put', 'IV_call', 'country', 'underlying_return', 'underlying_log_return',
-            'underlying_volatility'])
-        A1 = simulate_trade(A1, False, 0.0, False)
-        wf(A1, filename, "1A")
-
-        #1B: Agentti tietää osingot, ei kuluja
-        B1 = pd.read_csv(csv)
-        B1 = B1.drop(columns=['Date', 'put_moneyness', 'call_moneyness',
-            'IV_put', 'IV_call', 'country', 'underlying_return', 'underlying_log_return',
-            'underlying_volatility'])
-        B1 = simulate_trade(B1, True, 0.0, False)
-        wf(B1, filename, "1B")
-
-        # 2A: Agentti ei tiedä osinkoja, kuluja
-        A2 = pd.read_csv(csv)
-        A2 = A2.drop(columns=['Date', 'put_moneyness', 'call_moneyness',
-            'IV_put', 'IV_call'])
-        A2 = simulate_trade(A2, False, low_fee, False)
-        wf(A2, filename, "2A")
-
-        # 2B: Agentti tietää osingot, kuluja
-        B2 = pd.read_csv(csv)
-
-        B2 = B2.drop(columns=['Date', 'put_moneyness', 'call_moneyness',
-            'IV_put', 'IV_call', 'country', 'underlying_return', 'underlying_log_return',
-            'underlying_volatility'])
-        B2 = simulate_trade(B2, False, low_fee, False)
-        wf(B2, filename, "2B")
-
-        # 3A: Agentti ei tiedä osinkoja, kuluilla ja lagilla
-        A3 = pd.read_csv(csv)
-        A3 = A3.drop(columns=['Date', 'put_moneyness', 'call_moneyness',
-            'country', 'underlying_return', 'underlying_log_return',
-            'underlying_volatility'])
-        A3 = simulate_trade(A3, False, low_fee, True)
-        wf(A3, filename, "3A")
-
-        # 3B: Agentti tietää osingot, kuluilla ja lagilla
-        B3 = pd.read_csv(csv)
-        B3 = B3.drop(columns=['Date', 'put_moneyness', 'call_moneyness',
-            'country', 'underlying_return', 'underlying_log_return',
-            'underlying_volatility'])
-        B3 = simulate_trade(B3, True, low_fee, True)
-        wf(B3, filename, "3B")
-
-        # 4A: Agentti ei tiedä osinkoja, isommat kulut
-        # ----------------------------
-        A4 = pd.read_csv(csv)
-        A4 = A4.drop(columns=['Date', 'put_moneyness', 'call_moneyness',
-            'IV_put', 'IV_call', 'country', 'underlying_return', 'underlying_log_return',
-            'underlying_volatility'])
-        A4 = simulate_trade(A4, False, high_fee, False)
-        wf(A4, filename, "4A")
-
-        # 4B: Agentti tietää osingot, isommat kulut
-        B4 = pd.read_csv(csv)
-        B4 = B4.drop(columns=['Date', 'put_moneyness', 'call_moneyness',
-            'IV_put', 'IV_call', 'country','underlying_return', 'underlying_log_return',
-            'underlying_volatility'])
-        B4 = simulate_trade(B4, True, high_fee, False)
-        wf(B4, filename, "4B")
-
-        # 5A: Agentti ei tiedä osinkoja, isommat kulut ja lagilla
-        A5 = pd.read_csv(csv)
-        A5 = A5.drop(columns=['Date', 'put_moneyness', 'call_moneyness',
-            'country', 'underlying_return', 'underlying_log_return',
-            'underlying_volatility'])
-        A5 = simulate_trade(A5, False, high_fee, True)
-        wf(A5, filename, "5A")
-
-        # 5B: agentti tietää osingot, isompi kulu ja lagi
-        B5 = pd.read_csv(csv)
-        B5 = B5.drop(columns=['Date', 'put_moneyness', 'call_moneyness',
-            'country', 'underlying_return', 'underlying_log_return',
-            'underlying_volatility'])
-        B5 = simulate_trade(B5, True, high_fee, True)
-        wf(B5, filename, "5B")
-
-def plot(df, fee, country, show_plot=True):
-    df["error"] = df["y"] - df["x"]
-    df["violation"] = df["error"].abs() > fee
-    df["year_month"] = df["Date"].dt.to_period("M").astype(str)
-    df["min_vol"] = df[["call_v", "put_v"]].min(axis=1)
-    df["max_trading_vol"] = df["min_vol"] * 0.1
-    df["vol_witherror"] = df["min_vol"] * df["violation"]
-    # If a violation occurs, arbitrage volume equals max_trading_vol; otherwise, 0.
-    df["arbitrage_vol"] = df["max_trading_vol"] * df["violation"].astype(int)
-    monthly_arbitrage = df.groupby(["year_month", "country"]).agg(
-        total_possible=("min_vol", "sum"),
-        available=("arbitrage_vol", "sum")
-    ).reset_index()
-    monthly_arbitrage["percentage_available"] = monthly_arbitrage["available"] / monthly_arbitrage["total_possible"]
+        f.write("".join(report))
+    table = pd.DataFrame(rows)
+    table.to_json(results_path, orient="records", indent=1)
+    return table
+
+# ------------------------------
+# Fee sensitivity
+# ------------------------------
+
+def _suffix_sums(values):
+    # out[i] = values[i:].sum(), with out[len(values)] = 0.
+    return np.concatenate([np.cumsum(values[::-1])[::-1], [0.0]])
+
+
+class FeeCurve:
+    """
+    The non-lagged simulate_trade result as a function of the fee. A row trades when
+    |y - x| > fee, so with the rows sorted by |y - x| every fee is a searchsorted into
+    suffix sums: total profit is sum(|e| * n) - fee * sum(n) over the trading rows (n being
+    max_trade_count) and the mean return is (sum(|e| / c) - fee * sum(1 / c)) / trades
+    (c being capital_per_trade).
+    """
+
+    def __init__(self, data, divs: bool):
+        data = data.query("call_v > 10 & put_v > 10 & ulying_volume > 0.01")
+        x = data['x'] if divs else data['x'] + data['PV_alldivs']
+        abs_error = (data['y'] - x).abs().to_numpy()
+        trade_count = data[['call_v', 'put_v', 'ulying_volume']].min(axis=1).to_numpy() * 0.1
+        capital = (x.abs() + data['y'].abs()).to_numpy()
+        # Rows without a whole trade never count, whatever the fee.
+        keep = ~np.isnan(abs_error) & (trade_count.astype(int) > 0)
+        order = np.argsort(abs_error[keep], kind="stable")
+        self.abs_error = abs_error[keep][order]
+        trade_count, capital = trade_count[keep][order], capital[keep][order]
+        self.error_volume = _suffix_sums(self.abs_error * trade_count)
+        self.volume = _suffix_sums(trade_count)
+        self.error_per_capital = _suffix_sums(self.abs_error / capital)
+        self.per_capital = _suffix_sums(1 / capital)
+
+    def evaluate(self, fees):
+        """trades, total_profit and mean_return at every fee in fees."""
+        fees = np.asarray(fees, dtype=float)
+        first = np.searchsorted(self.abs_error, fees, side="right")
+        trades = len(self.abs_error) - first
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_return = np.where(trades > 0,
+                (self.error_per_capital[first] - fees * self.per_capital[first]) / trades, np.nan)
+        return pd.DataFrame({
+            'fee': fees,
+            'trades': trades,
+            'total_profit': self.error_volume[first] - fees * self.volume[first],
+            'mean_return': mean_return,
+        })
+
+
+def fee_curves(datas:list, countries:list, fees, divs=True):
+    """FeeCurve.evaluate for every country, stacked into one frame with a country column."""
+    curves = []
+    for name, country in zip(datas, countries):
+        curve = FeeCurve(read_frame(name, columns=TRADE_COLUMNS), divs).evaluate(fees)
+        curve.insert(0, 'country', country)
+        curves.append(curve)
+    return pd.concat(curves, ignore_index=True)
+
+def plot_fee_curves(curves, show_plot=True):
+    fig, axes = plt.subplots(1, 3, figsize=(15, 4))
+    for country, curve in curves.groupby('country', sort=False):
+        for ax, column in zip(axes, ['total_profit', 'trades', 'mean_return']):
+            ax.plot(curve['fee'], curve[column], label=country)
+    for ax, title in zip(axes, ['Total profit', 'Trades', 'Mean return']):
+        ax.set_title(title)
+        ax.set_xlabel("Fee")
+    axes[0].legend()
+    plt.tight_layout()
+    if show_plot:
+        plt.show()
+
+
+class MonthlyAvailability:
+    """
+    The monthly figures of plot for any fee: per (year_month, country) the sum of the
+    minimum option volume, and the |y - x| sorted with suffix sums of the tradable volume
+    (10 % of the minimum volume), so the volume available at a fee is one searchsorted.
+    """
+
+    def __init__(self, df):
+        min_vol = df[["call_v", "put_v"]].min(axis=1).to_numpy()
+        abs_error = (df["y"] - df["x"]).abs().to_numpy()
+        groups = pd.DataFrame({
+            'year_month': df["Date"].dt.to_period("M").astype(str).to_numpy(),
+            'country': df["country"].to_numpy(),
+        })
+        codes, keys = pd.MultiIndex.from_frame(groups).factorize(sort=True)
+        self.keys = keys.set_names(list(groups.columns))
+        self.total_possible = np.bincount(codes, weights=min_vol, minlength=len(self.keys))
+        # Rows with a NaN error are never violations, so only the volume total needs them.
+        valid = ~np.isnan(abs_error)
+        order = np.lexsort((abs_error[valid], codes[valid]))
+        self.abs_error = abs_error[valid][order]
+        self.available = _suffix_sums(min_vol[valid][order] * 0.1)
+        self.bounds = np.searchsorted(codes[valid][order], np.arange(len(self.keys) + 1))
+
+    def at(self, fee):
+        """The monthly_arbitrage frame plot draws, for fee."""
+        first = np.array([lo + np.searchsorted(self.abs_error[lo:hi], fee, side="right")
+            for lo, hi in zip(self.bounds[:-1], self.bounds[1:])], dtype=int)
+        available = self.available[first] - self.available[self.bounds[1:]]
+        monthly = self.keys.to_frame(index=False)
+        monthly["total_possible"] = self.total_possible
+        monthly["available"] = available
+        monthly["percentage_available"] = available / self.total_possible
+        return monthly
+
+
+def _monthly_labels(monthly_arbitrage, fee, country):
     tick_positions = np.arange(0, len(monthly_arbitrage), 12)
     tick_labels = [str(2011+i) for i in range(len(tick_positions))]
+    title = f"How much of monthly volume has potential for arbitrage in {country} when fee is {fee:.2f}"
+    return tick_positions, tick_labels, title
+
+def plot(df, fee, country, show_plot=True, availability=None):
+    """availability (a MonthlyAvailability of df) lets several fees share one preparation."""
+    if availability is None:
+        availability = MonthlyAvailability(df)
+    monthly_arbitrage = availability.at(fee)
+    tick_positions, tick_labels, title = _monthly_labels(monthly_arbitrage, fee, country)
     plt.figure(figsize=(10,6))
     plt.xticks(tick_positions, tick_labels)
     plt.bar(range(len(monthly_arbitrage)), monthly_arbitrage["percentage_available"])
-    plt.title(f"How much of monthly volume has potential for arbitrage in {country} when fee is {fee:.2f}")
+    plt.title(title)
     plt.xlabel("Year")
     plt.ylabel("Percentage of Available Volume")
     plt.tight_layout()
@@ -206,17 +320,33 @@ def plot(df, fee, country, show_plot=True):
     if show_plot:
         plt.show()
 
-def plot_all_histograms(csvs, low_fees, high_fees, countries, show_plot=True):
-    for csv, low_fee, high_fee, country in zip(csvs, low_fees, high_fees, countries):
-        df = pd.read_csv(csv, parse_dates=['Date'])
+def plot_spec(availability, fee, country, path):
+    """plot as a figure spec for render_figures."""
+    monthly_arbitrage = availability.at(fee)
+    tick_positions, tick_labels, title = _monthly_labels(monthly_arbitrage, fee, country)
+    return bar_spec(monthly_arbitrage["percentage_available"], path, title, "Year",
+        "Percentage of Available Volume", tick_positions, tick_labels)
+
+def plot_all_histograms(names, low_fees, high_fees, countries, show_plot=True, render_dir=None):
+    """With render_dir the figures are written there by render_figures instead of drawn here."""
+    specs = []
+    for name, low_fee, high_fee, country in zip(names, low_fees, high_fees, countries):
+        df = read_frame(name)
         df = df[(df["call_v"] > 10) & (df["put_v"] > 10)]
-        plot(df, low_fee, country, True)
-        plot(df, high_fee, country, True)
+        availability = MonthlyAvailability(df)
+        if render_dir:
+            for fee in (low_fee, high_fee):
+                specs.append(plot_spec(availability, fee, country,
+                    f"{render_dir}/1_{country}_{fee:.2f}.png"))
+        else:
+            plot(df, low_fee, country, show_plot, availability)
+            plot(df, high_fee, country, show_plot, availability)
+    if render_dir:
+        render_figures(specs, render_dir)
 
 
 if __name__ == "__main__":
-    datas_list = ['processed_data/dk_processed_data.csv','processed_data/no_processed_data.csv',
-        'processed_data/se_processed_data.csv']
+    datas_list = ['dk_processed_data', 'no_processed_data', 'se_processed_data']
     sek_fees = 30.0
     dkk_sek = 1.45
     nok_sek = 0.96
@@ -224,4 +354,9 @@ if __name__ == "__main__":
     high_fees = [sek_fees*dkk_sek*2, sek_fees*nok_sek*2, sek_fees*2]
     countries = ['Denmark', 'Norway', 'Sweden']
     wrapper(datas_list, low_fees, high_fees, countries)
+    # Profit, trades and mean return for a continuum of fees (in each country's currency)
+    fee_grid = np.linspace(0, max(high_fees), 1000)
+    curves = fee_curves(datas_list, countries, fee_grid)
+    curves.to_json("fee_curves.json", orient="records", indent=1)
+    plot_fee_curves(curves)
     plot_all_histograms(datas_list, low_fees, high_fees, countries)
@@ -0,0 +1,164 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import pandas as pd
+
+from timeseries import SERIES_DB_PATH, SeriesStore
+
+# ------------------------------
+# Incremental market data fetching
+# ------------------------------
+#
+# A provider is any object with history(symbol, field, start, end) returning a Series of
+# that field indexed by date (start and end are 'YYYY-MM-DD' strings, both inclusive).
+# fetch_incremental asks it only for the dates after what is already stored, for many
+# symbols at once on a bounded thread pool, retrying failed requests.
+
+DEFAULT_START = "2010-01-01"
+# Days before the last stored date that are fetched again, so late corrections and
+# quotes that were missing on the last refresh are picked up.
+OVERLAP_DAYS = 5
+
+
+class RefinitivProvider:
+    """Refinitiv Data Library get_history; the session is opened on first use."""
+
+    def __init__(self):
+        self.rd = None
+
+    def history(self, symbol, field, start, end):
+        if self.rd is None:
+            import refinitiv.data as rd
+            rd.open_session()
+            self.rd = rd
+        data = self.rd.get_history(symbol, interval='daily', start=start, end=end, fields=[field])
+        return data[field] if len(data) else pd.Series(dtype=float)
+
+
+class YahooProvider:
+    """yfinance daily bars; field is a column of yf.download such as 'Close'."""
+
+    def history(self, symbol, field, start, end):
+        import yfinance as yf
+        # yfinance's end date is exclusive.
+        end = (pd.Timestamp(end) + pd.Timedelta(days=1)).strftime('%Y-%m-%d')
+        data = yf.download(symbol, start=start, end=end, progress=False, auto_adjust=False)
+        if data.empty:
+            return pd.Series(dtype=float)
+        series = data[field]
+        # Newer yfinance versions return one column per ticker even for a single one.
+        return series.iloc[:, 0] if isinstance(series, pd.DataFrame) else series
+
+
+class CannedProvider:
+    """
+    Serves fixed series ({symbol: Series indexed by date}) as a provider would, for offline
+    runs and tests. delay (seconds) stands in for the latency of a request, and the first
+    failures requests of every symbol raise ConnectionError.
+    """
+
+    def __init__(self, series, delay=0.0, failures=0):
+        self.series = series
+        self.delay = delay
+        self.failures = failures
+        self.attempts = {}
+        self.requests = []
+
+    def history(self, symbol, field, start, end):
+        self.requests.append((symbol, field, start, end))
+        self.attempts[symbol] = self.attempts.get(symbol, 0) + 1
+        time.sleep(self.delay)
+        if self.attempts[symbol] <= self.failures:
+            raise ConnectionError(f"canned failure for {symbol}")
+        series = self.series[symbol]
+        return series[(series.index >= pd.Timestamp(start)) & (series.index <= pd.Timestamp(end))]
+
+
+def fetch_start(stored, symbol, start=DEFAULT_START, overlap_days=OVERLAP_DAYS):
+    """First date to request for symbol: overlap_days before its last stored observation."""
+    if stored is None or symbol not in stored.columns:
+        return start
+    observed = stored[symbol].dropna()
+    if observed.empty:
+        return start
+    return max(pd.Timestamp(start), observed.index.max() - pd.Timedelta(days=overlap_days)).strftime('%Y-%m-%d')
+
+def _history_with_retries(provider, symbol, field, start, end, retries, backoff):
+    for attempt in range(retries + 1):
+        try:
+            series = provider.history(symbol, field, start, end)
+            series.index = pd.to_datetime(series.index)
+            return pd.to_numeric(series, errors='coerce')
+        except Exception as error:
+            if attempt == retries:
+                raise
+            print(f"{symbol}: {error!r}, retrying")
+            time.sleep(backoff * 2**attempt)
+
+def fetch_incremental(fields, provider, stored=None, start=DEFAULT_START, end=None, max_workers=8,
+        retries=3, backoff=1.0, overlap_days=OVERLAP_DAYS):
+    """
+    Brings stored (a frame indexed by date with one column per symbol, or None) up to end
+    (default today) for fields, {symbol: field}. Every symbol is requested from
+    fetch_start on, with at most max_workers requests in flight; fetched values replace
+    stored ones on the same dates. Symbols that still fail after retries keep their stored
+    data. Returns (updated frame, failed symbols).
+    """
+    end = end or datetime.now().strftime('%Y-%m-%d')
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {symbol: pool.submit(_history_with_retries, provider, symbol, field,
+                fetch_start(stored, symbol, start, overlap_days), end, retries, backoff)
+            for symbol, field in fields.items()}
+
+    fetched, failed = {}, []
+    for symbol, future in futures.items():
+        try:
+            fetched[symbol] = future.result()
+        except Exception as error:
+            print(f"{symbol}: failed ({error!r})")
+            failed.append(symbol)
+
+    new = pd.DataFrame(fetched)
+    if stored is None:
+        updated = new
+    else:
+        updated = new.combine_first(stored) if not new.empty else stored.copy()
+    updated.index.name = 'Date'
+    return updated.sort_index(), failed
+
+def read_stored(path):
+    if not os.path.exists(path):
+        return None
+    return pd.read_csv(path, parse_dates=['Date'], index_col='Date')
+
+def refresh_csv(path, fields, provider, columns=None, ffill=False, **kwargs):
+    """
+    fetch_incremental against the CSV at path (created if missing), written back in place.
+    columns, given, fixes the column order; ffill forward fills the gaps like the original
+    downloads did. Returns the failed symbols.
+    """
+    updated, failed = fetch_incremental(fields, provider, read_stored(path), **kwargs)
+    if columns is not None:
+        updated = updated.reindex(columns=columns)
+    if ffill:
+        updated = updated.ffill()
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    updated.to_csv(tmp)
+    os.replace(tmp, path)
+    return failed
+
+def refresh_store(fields, provider, db_path=SERIES_DB_PATH, **kwargs):
+    """
+    fetch_incremental against the series store: only the fetched values that are new or
+    changed are recorded (a changed one as a revision). Returns the failed symbols.
+    """
+    with SeriesStore(db_path) as store:
+        stored = store.frame(list(fields))
+        updated, failed = fetch_incremental(fields, provider, stored if len(stored.columns) else None,
+            **kwargs)
+        written = store.write(updated)
+    print(f"{written} values stored")
+    return failed
@@ -0,0 +1,289 @@
+import io
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# ------------------------------
+# Reading and writing processed_data between pipeline stages
+# ------------------------------
+
+PROCESSED_DIR = "processed_data"
+DEFAULT_FORMAT = "npy"
+FORMATS = ("npy", "parquet", "csv")
+
+# Column types of the *_processed_data frames; columns not listed keep their own dtype.
+PROCESSED_SCHEMA = {
+    'Date': 'datetime64[ns]',
+    'y': 'float64', 'x': 'float64',
+    'call_v': 'float64', 'put_v': 'float64',
+    'ulying_div': 'float64', 'ulying_volume': 'float64',
+    'strike': 'float64', 'maturity': 'float64',
+    'call_price': 'float64', 'put_price': 'float64', 'ulying_price': 'float64',
+    'risk_free_rate': 'float64',
+    'put_moneyness': 'float64', 'call_moneyness': 'float64',
+    'IV_put': 'float64', 'IV_call': 'float64',
+    'country': 'str',
+    'contract': 'int64',
+    'PV_alldivs': 'float64',
+    'EEP_call': 'float64', 'EEP_put': 'float64',
+}
+
+
+def frame_path(name, fmt, base_dir=PROCESSED_DIR):
+    """npy frames are a directory with one .npy per column; the others are single files."""
+    return os.path.join(base_dir, name + "." + fmt)
+
+def _stamp_path(name, fmt, base_dir):
+    # For npy the schema is written last, so its mtime is when the frame was completed.
+    path = frame_path(name, fmt, base_dir)
+    return os.path.join(path, "schema.json") if fmt == "npy" else path
+
+def apply_schema(df):
+    for col, dtype in PROCESSED_SCHEMA.items():
+        if col in df.columns and dtype != 'str':
+            df[col] = df[col].astype(dtype)
+    return df
+
+def _write_npy(df, path):
+    os.makedirs(path, exist_ok=True)
+    schema = []
+    for i, col in enumerate(df.columns):
+        values = df[col].to_numpy()
+        if values.dtype == object or PROCESSED_SCHEMA.get(col) == 'str':
+            values = values.astype(str)
+        # Replaced rather than overwritten, so frames still mapping the old file keep it.
+        tmp = os.path.join(path, f"{i}.npy.tmp")
+        with open(tmp, "wb") as f:
+            np.save(f, values, allow_pickle=False)
+        os.replace(tmp, os.path.join(path, f"{i}.npy"))
+        schema.append({'name': col, 'file': f"{i}.npy", 'dtype': str(values.dtype)})
+    with open(os.path.join(path, "schema.json"), "w") as f:
+        json.dump({'columns': schema, 'rows': len(df)}, f)
+
+def _npy_columns(path, columns=None, mmap=True):
+    """(rows, [(name, array)]) of the stored columns, memory-mapped copy-on-write by default."""
+    with open(os.path.join(path, "schema.json")) as f:
+        schema = json.load(f)
+    wanted = [c for c in schema['columns'] if columns is None or c['name'] in columns]
+    # schema.json has the committed length; a column file may run past it (see append_frame).
+    return schema['rows'], [(c['name'], np.load(os.path.join(path, c['file']),
+        mmap_mode="c" if mmap else None)[:schema['rows']]) for c in wanted]
+
+def _npy_frame(arrays, start=0, stop=None):
+    # copy=False keeps the numeric columns views of the memory maps, so only the pages that
+    # are used get read; writes to them stay in memory ("c" mode). Strings are converted.
+    df = pd.DataFrame({name: values[start:stop] for name, values in arrays}, copy=False)
+    df.index = pd.RangeIndex(start, start + len(df))
+    return df
+
+def _read_npy(path, columns=None, mmap=True):
+    return _npy_frame(_npy_columns(path, columns, mmap)[1])
+
+def _read_csv(path, columns=None):
+    df = pd.read_csv(path, usecols=columns)
+    if 'Date' in df.columns:
+        df['Date'] = pd.to_datetime(df['Date'])
+    return apply_schema(df)
+
+def write_frame(df, name, fmt=DEFAULT_FORMAT, base_dir=PROCESSED_DIR, csv_export=False):
+    """
+    Writes a processed frame (without its index, like the to_csv(index=False) calls did) in
+    fmt. csv_export additionally writes name.csv for tools that only read CSV, such as
+    calculate_eeps. Without it an existing name.csv is removed, since it no longer matches
+    and read_frame would prefer it once it is edited.
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt}. Use one of {FORMATS}.")
+    os.makedirs(base_dir, exist_ok=True)
+    df = apply_schema(df.reset_index(drop=True).copy())
+    # The CSV goes first so that the binary copy is not mistaken for the older one.
+    csv_path = frame_path(name, "csv", base_dir)
+    if fmt == "csv" or csv_export:
+        df.to_csv(csv_path, index=False)
+    elif os.path.exists(csv_path):
+        os.remove(csv_path)
+    return _write_binary(df, name, fmt, base_dir)
+
+def _write_binary(df, name, fmt, base_dir):
+    # Writes only the npy or parquet copy; CSV copies are left alone.
+    path = frame_path(name, fmt, base_dir)
+    if fmt == "npy":
+        _write_npy(df, path)
+    elif fmt == "parquet":
+        df.to_parquet(path, index=False)
+    return path
+
+def available_formats(name, base_dir=PROCESSED_DIR):
+    """Formats name exists in, newest first."""
+    found = [(os.path.getmtime(_stamp_path(name, fmt, base_dir)), fmt) for fmt in FORMATS
+        if os.path.exists(_stamp_path(name, fmt, base_dir))]
+    return [fmt for _, fmt in sorted(found, reverse=True)]
+
+def _existing_formats(name, base_dir):
+    formats = available_formats(name, base_dir)
+    if not formats:
+        raise FileNotFoundError(f"No processed frame {name} in {base_dir}")
+    return formats
+
+def read_frame(name, columns=None, fmt=None, base_dir=PROCESSED_DIR):
+    """
+    Reads a processed frame, optionally only some columns. Without fmt the newest copy is
+    used: if the CSV has been rewritten after the binary copy (calculate_eeps edits the CSVs
+    in place), the CSV is read and the binary copy is refreshed from it; the CSV is kept,
+    a read never removes a copy. The numeric
+    columns of an npy frame are views of its memory-mapped files. For a frame that should
+    not be held in memory at once, see iter_frame.
+    """
+    if fmt is None:
+        formats = _existing_formats(name, base_dir)
+        fmt = formats[0]
+        if fmt == "csv" and len(formats) > 1:
+            df = _read_csv(frame_path(name, "csv", base_dir))
+            _write_binary(df, name, formats[1], base_dir)
+            return df if columns is None else df[list(columns)]
+
+    path = frame_path(name, fmt, base_dir)
+    if fmt == "npy":
+        return _read_npy(path, columns)
+    if fmt == "parquet":
+        return pd.read_parquet(path, columns=columns)
+    return _read_csv(path, columns)
+
+def refresh_frame(name, base_dir=PROCESSED_DIR):
+    """
+    Rewrites the binary copy of name from its CSV if the CSV is newer (see read_frame), so
+    that later iter_frame calls read row ranges of the binary copy again.
+    """
+    formats = _existing_formats(name, base_dir)
+    if formats[0] == "csv" and len(formats) > 1:
+        read_frame(name, base_dir=base_dir)
+
+def iter_frame(name, columns=None, chunk_size=1_000_000, fmt=None, base_dir=PROCESSED_DIR):
+    """
+    A processed frame chunk_size rows at a time, in order, without reading it whole: npy
+    chunks are row ranges of the memory-mapped columns, CSV is parsed chunk_size rows at a
+    time and parquet read in row batches. Chunks are indexed by row number like
+    read_frame(...).iloc[start:stop]. Without fmt the newest copy is read; a CSV newer than
+    the binary copy is streamed as it is, and refresh_frame updates the binary copy.
+    """
+    fmt = _existing_formats(name, base_dir)[0] if fmt is None else fmt
+    path = frame_path(name, fmt, base_dir)
+    if fmt == "npy":
+        rows, arrays = _npy_columns(path, columns)
+        for start in range(0, rows, chunk_size):
+            yield _npy_frame(arrays, start, start + chunk_size)
+    elif fmt == "parquet":
+        import pyarrow.parquet as pq
+        start = 0
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns):
+            chunk = batch.to_pandas()
+            chunk.index = pd.RangeIndex(start, start + len(chunk))
+            start += len(chunk)
+            yield chunk
+    else:
+        for chunk in pd.read_csv(path, usecols=columns, chunksize=chunk_size):
+            if 'Date' in chunk.columns:
+                chunk['Date'] = pd.to_datetime(chunk['Date'])
+            yield apply_schema(chunk)
+
+
+# ------------------------------
+# Appending to npy frames in place
+# ------------------------------
+
+def _column_values(values, dtype):
+    """values as dtype, or None when strings would not fit the stored width."""
+    values = np.asarray(values)
+    if dtype.kind == "U":
+        values = values.astype(str)
+        if values.dtype.itemsize > dtype.itemsize:
+            return None
+    return values.astype(dtype)
+
+def _npy_header(file):
+    """(version, shape, fortran_order, dtype, data offset) of a .npy file."""
+    with open(file, "rb") as f:
+        version = np.lib.format.read_magic(f)
+        read_header = (np.lib.format.read_array_header_1_0 if version == (1, 0)
+            else np.lib.format.read_array_header_2_0)
+        shape, fortran_order, dtype = read_header(f)
+        return version, shape, fortran_order, dtype, f.tell()
+
+def _resized_header(version, dtype, length):
+    header = io.BytesIO()
+    write_header = (np.lib.format.write_array_header_1_0 if version == (1, 0)
+        else np.lib.format.write_array_header_2_0)
+    write_header(header, {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False,
+        'shape': (length,)})
+    return header.getvalue()
+
+def append_frame(df, name, updates=None, base_dir=PROCESSED_DIR):
+    """
+    Adds the rows of df at the end of the npy frame name and, with updates (a frame with the
+    same columns indexed by row position), overwrites those rows, without rewriting the rest
+    of the frame: np.save leaves room in a column file's header for a longer first axis, so
+    only the header, the new data and the updated rows are written. schema.json holds the
+    committed length and is written last. A stale name.csv is removed. A frame that does not
+    exist yet, or whose columns or string widths do not fit, is written in full.
+
+    Returns the row positions of df's rows.
+    """
+    path = frame_path(name, "npy", base_dir)
+    schema_path = os.path.join(path, "schema.json")
+    if not os.path.exists(schema_path):
+        write_frame(df, name, base_dir=base_dir)
+        return np.arange(len(df))
+    with open(schema_path) as f:
+        schema = json.load(f)
+    rows = schema['rows']
+    df = apply_schema(df.reset_index(drop=True).copy())
+    updates = None if updates is None or updates.empty else apply_schema(updates.copy())
+
+    # Everything is checked before anything is written.
+    names = sorted(c['name'] for c in schema['columns'])
+    plan = []
+    fits = sorted(df.columns) == names and (updates is None or sorted(updates.columns) == names)
+    for c in schema['columns'] if fits else []:
+        file = os.path.join(path, c['file'])
+        version, shape, fortran_order, dtype, offset = _npy_header(file)
+        header = _resized_header(version, dtype, rows + len(df))
+        new = _column_values(df[c['name']].to_numpy(), dtype)
+        changed = None if updates is None else _column_values(updates[c['name']].to_numpy(), dtype)
+        if (len(shape) != 1 or fortran_order or len(header) != offset or new is None
+                or (updates is not None and changed is None)):
+            fits = False
+            break
+        plan.append((file, dtype, offset, header, new, changed))
+
+    if fits:
+        for file, dtype, offset, header, new, changed in plan:
+            if changed is not None:
+                mapped = np.memmap(file, dtype, mode="r+", offset=offset, shape=(rows,))
+                mapped[updates.index.to_numpy(dtype=np.int64)] = changed
+                mapped.flush()
+                del mapped
+            with open(file, "r+b") as f:
+                # The data goes before the header, so the file is readable throughout.
+                f.seek(offset + rows * dtype.itemsize)
+                f.write(new.tobytes())
+                f.truncate()
+                f.seek(0)
+                f.write(header)
+        schema['rows'] = rows + len(df)
+        tmp = schema_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(schema, f)
+        os.replace(tmp, schema_path)
+    else:
+        full = read_frame(name, fmt="npy", base_dir=base_dir).copy()
+        if updates is not None:
+            for col in updates.columns:
+                full.loc[updates.index, col] = updates[col].to_numpy()
+        write_frame(pd.concat([full, df], ignore_index=True), name, base_dir=base_dir)
+
+    csv_path = frame_path(name, "csv", base_dir)
+    if os.path.exists(csv_path):
+        os.remove(csv_path)
+    return np.arange(rows, rows + len(df))
@@ -1,20 +1,15 @@
-import yfinance as yf
-import pandas as pd
+from data3 import CURRENCY_RATES
+from fetch import YahooProvider, refresh_store
 
-# Define the currency pairs
-currency_pairs = ['SEKNOK=X', 'SEKDKK=X']
+# Define the currency pairs (the SEK price of every currency in data3.CURRENCY_RATES)
+currency_pairs = list(CURRENCY_RATES.values())
 
-# Define the start and end dates
+# Define the start date; only dates after the last stored rate are downloaded
 start_date = '2010-01-01'
-end_date = '2025-02-09'
 
-# Download the historical data
-data = yf.download(currency_pairs, start=start_date, end=end_date)
 
-# Extract the 'Adj Close' prices
-exchange_rates = data['Close']
-
-# Display the data
-
-# Save the data to a CSV file
-exchange_rates.to_csv('exchange_rates.csv')
+if __name__ == "__main__":
+    # Written to the series store that data3.read_exchange_rates reads
+    failed = refresh_store({pair: 'Close' for pair in currency_pairs}, YahooProvider(),
+        start=start_date)
+    print("failed:", failed if failed else "none")
@@ -1,43 +1,7 @@
-import refinitiv.data as rd
-import pandas as pd
-import calendar
-from datetime import datetime
-from datetime import timedelta
-import pandas_market_calendars as mcal
-
-session = rd.open_session()
-
-print(session)
-
-def get_risk_free_rates(start_date, ric_list1, ric_list2):
-    end_date = datetime.now().strftime('%Y-%m-%d')
-
-    final_data = pd.DataFrame()
-
-    for ric in ric_list1:
-        print(ric)
-        data = rd.get_history(ric,
-                                interval='daily',
-                                start=start_date,
-                                end=end_date,
-                                fields=['FIXING_1'])
-        final_data[ric] = data["FIXING_1"]
-
-    for ric in ric_list2:
-        print(ric)
-        data = rd.get_history(ric,
-                                interval='daily',
-                                start=start_date,
-                                end=end_date,
-                                fields=['ZERO_YLD1'])
-        final_data[ric] = data["ZERO_YLD1"]
-
-    final_data.fillna(method='ffill', inplace=True)
-
-    print(final_data)
-    return final_data
-
+from fetch import RefinitivProvider, refresh_store
+from timeseries import SERIES_DB_PATH
 
+# RICs quoted as fixings and as zero yields
 list1 = ["OINOKSWD=", "OINOK1MD=", "OINOK2MD=", "OINOK3MD=", "OINOK6MD=",
     "STISEKTNDFI=", "STISEK1WDFI=", "STISEK1MDFI=", "STISEK2MDFI=", "STISEK3MDFI=", "STISEK6MDFI=",
     "CIDKKSWD=", "CIDKK1MD=", "CIDKK3MD=", "CIDKK6MD=", "CIDKK1YD=", 'CIDKK3MD=']
@@ -45,14 +9,29 @@ list1 = ["OINOKSWD=", "OINOK1MD=", "OINOK2MD=", "OINOK3MD=", "OINOK6MD=",
 list2 = ["NOKABQOD1YZ=R", "NOKONZ=R", "DKKONZ=R", "DKK2MZ=R", "DKK9MZ=R", "DKKABQCD1Y3MZ=R", "SEGOV1Y3MZ=R", "SEGOV1YZ=R", "SEK9MZ=R",
             "NOK9MZ=R", "NOK1YZ=R", "NOK1Y3MZ=R"]
 
-data = get_risk_free_rates("2010-01-01", list1, list2)
-
 column_order = ['NOKONZ=R','OINOKSWD=', 'OINOK1MD=', 'OINOK2MD=', 'OINOK3MD=', 'OINOK6MD=', 'NOK9MZ=R', "NOK1YZ=R",'NOK1Y3MZ=R',
     'STISEKTNDFI=', 'STISEK1WDFI=', 'STISEK1MDFI=', 'STISEK2MDFI=', 'STISEK3MDFI=', 'STISEK6MDFI=', 'SEK9MZ=R', 'SEGOV1YZ=R','SEGOV1Y3MZ=R',
     'DKKONZ=R','CIDKKSWD=', 'CIDKK1MD=', 'DKK2MZ=R', 'CIDKK6MD=','DKK9MZ=R', 'CIDKK1YD=','DKKABQCD1Y3MZ=R']
 
-data = data.reindex(columns=column_order)
-print(data)
-
-
-data.to_csv('risk_free_rates2.csv')
+def risk_free_fields(ric_list1, ric_list2):
+    """{RIC: field} for fetch: FIXING_1 for the first list, ZERO_YLD1 for the second."""
+    fields = {ric: 'FIXING_1' for ric in ric_list1}
+    fields.update({ric: 'ZERO_YLD1' for ric in ric_list2})
+    return fields
+
+def get_risk_free_rates(start_date, ric_list1, ric_list2, provider=None, db_path=SERIES_DB_PATH,
+        max_workers=8):
+    """
+    Updates the rates in the series store (which rates.read_rates reads) with the dates
+    after their last observations (the whole history from start_date for a new RIC),
+    requesting the RICs concurrently.
+    """
+    provider = RefinitivProvider() if provider is None else provider
+    fields = {ric: field for ric, field in risk_free_fields(ric_list1, ric_list2).items()
+        if ric in column_order}
+    return refresh_store(fields, provider, db_path, start=start_date, max_workers=max_workers)
+
+
+if __name__ == "__main__":
+    failed = get_risk_free_rates("2010-01-01", list1, list2)
+    print("failed:", failed if failed else "none")
@@ -0,0 +1,130 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# ------------------------------
+# kovadata3.csv -> long-format column store
+# ------------------------------
+
+OPTIONS_PATH = "unprocessed_data/kovadata3.csv"
+OPTIONS_STORE_DIR = "processed_data/options_store"
+STORE_VERSION = 1
+
+# The 9 columns of every contract group in kovadata3.csv, in file order (raw units:
+# volume in thousands, maturity in days).
+FIELDS = ['ulying_div', 'ulying_volume', 'maturity', 'strike', 'call_price',
+    'ulying_price', 'call_v', 'put_price', 'put_v']
+
+
+def read_wide_options(path=OPTIONS_PATH):
+    # Read options data; note that the index is set and then converted to datetime
+    options = pd.read_csv(path, header=[0, 1, 2])
+    options = options.set_index('Date')
+    # The index contains tuples; we take the first element and convert to datetime
+    options.index = options.index.map(lambda x: x[0])
+    options.index = pd.to_datetime(options.index, format='%m/%d/%y')
+    return options
+
+def source_fingerprint(path):
+    stat = os.stat(path)
+    return {'source': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+        'version': STORE_VERSION}
+
+def wide_to_long(options):
+    """
+    Turns the wide 9-columns-per-contract frame into long arrays sorted by (contract, date).
+    Rows where a contract has no data at all are dropped.
+
+    Returns (arrays, contracts) where arrays maps 'date' (days since epoch), 'contract'
+    (group number) and every name in FIELDS to a 1-D array, and contracts lists the
+    original 3-level column headers of each group.
+    """
+    n_groups = len(options.columns) // 9
+    values = options.iloc[:, :n_groups * 9].to_numpy(dtype=float)
+    cube = values.reshape(len(options), n_groups, 9).transpose(1, 0, 2)
+    contract, row = np.nonzero(~np.isnan(cube).all(axis=2))
+
+    days = options.index.values.astype("datetime64[D]").astype(np.int64)
+    arrays = {'date': days[row], 'contract': contract.astype(np.int32)}
+    for k, field in enumerate(FIELDS):
+        arrays[field] = cube[contract, row, k]
+
+    contracts = []
+    for g in range(n_groups):
+        columns = [[str(level) for level in col] for col in options.columns[g * 9:(g + 1) * 9]]
+        contracts.append({'columns': columns, 'country': columns[0][2]})
+    return arrays, contracts
+
+def build_options_store(path=OPTIONS_PATH, store_dir=OPTIONS_STORE_DIR, force=False):
+    """
+    Parses kovadata3.csv once and writes it as one .npy file per long-format column plus a
+    meta.json with the contract headers. Nothing is done while meta.json matches the
+    source file's size and modification time.
+    """
+    meta_path = os.path.join(store_dir, "meta.json")
+    fingerprint = source_fingerprint(path)
+    if not force and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            if json.load(f).get('fingerprint') == fingerprint:
+                return store_dir
+
+    os.makedirs(store_dir, exist_ok=True)
+    arrays, contracts = wide_to_long(read_wide_options(path))
+    for name, values in arrays.items():
+        np.save(os.path.join(store_dir, name + ".npy"), values)
+    offsets = np.searchsorted(arrays['contract'], np.arange(len(contracts) + 1))
+    np.save(os.path.join(store_dir, "offsets.npy"), offsets)
+
+    # meta.json is written last, so a store with a matching fingerprint is complete.
+    with open(meta_path, "w") as f:
+        json.dump({'fingerprint': fingerprint, 'fields': FIELDS, 'contracts': contracts,
+            'rows': int(len(arrays['date']))}, f)
+    return store_dir
+
+def read_store_meta(store_dir=OPTIONS_STORE_DIR):
+    with open(os.path.join(store_dir, "meta.json")) as f:
+        return json.load(f)
+
+def load_options_long(columns=None, store_dir=OPTIONS_STORE_DIR):
+    """
+    The long table as a DataFrame with Date, contract and country plus the requested
+    FIELDS (all of them by default). Only the requested columns are read from disk.
+    """
+    meta = read_store_meta(store_dir)
+    columns = FIELDS if columns is None else columns
+
+    def column(name):
+        return np.load(os.path.join(store_dir, name + ".npy"), mmap_mode="r")
+
+    contract = np.asarray(column("contract"))
+    countries = pd.Categorical([c['country'] for c in meta['contracts']])
+    df = pd.DataFrame({
+        'Date': np.asarray(column("date")).astype("datetime64[D]").astype("datetime64[ns]"),
+        'contract': contract,
+        'country': pd.Categorical.from_codes(countries.codes[contract], countries.categories),
+    })
+    for name in columns:
+        df[name] = np.asarray(column(name))
+    return df
+
+def iter_group_frames(store_dir=OPTIONS_STORE_DIR):
+    """
+    Yields one frame per contract in the layout process_option_group expects: the 9 fields
+    under the contract's original 3-level headers, indexed by date. Each frame is built
+    from memory-mapped columns, so only one contract is materialized at a time.
+    """
+    meta = read_store_meta(store_dir)
+    offsets = np.load(os.path.join(store_dir, "offsets.npy"))
+    days = np.load(os.path.join(store_dir, "date.npy"), mmap_mode="r")
+    fields = [np.load(os.path.join(store_dir, name + ".npy"), mmap_mode="r") for name in FIELDS]
+    for g, contract in enumerate(meta['contracts']):
+        lo, hi = offsets[g], offsets[g + 1]
+        index = pd.DatetimeIndex(np.asarray(days[lo:hi]).astype("datetime64[D]").astype("datetime64[ns]"))
+        frame = pd.DataFrame(
+            np.column_stack([f[lo:hi] for f in fields]),
+            index=index,
+            columns=pd.MultiIndex.from_tuples([tuple(c) for c in contract['columns']]),
+        )
+        yield frame
@@ -0,0 +1,362 @@
+import hashlib
+import inspect
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import data2
+import data3
+import eep
+import ingest
+import rates
+import timeseries
+from frame_io import append_frame, available_formats, read_frame, write_frame
+
+# ------------------------------
+# Content-addressed stage cache
+# ------------------------------
+
+CACHE_DIR = "processed_data/stage_cache"
+APPEND_DIR = "processed_data/append_state"
+EXCHANGE_RATES_PATH = "unprocessed_data/exchange_rates.csv"
+COUNTRY_FRAMES = {'DENMARK': 'dk_processed_data', 'SWEDEN': 'se_processed_data',
+    'NORWAY': 'no_processed_data'}
+
+# file_hash results keyed by (path, size, mtime), so unchanged files are hashed once per process.
+_file_hashes = {}
+
+
+def hash_parts(*parts):
+    """sha256 over strings, bytes, dicts and lists (dicts are hashed in key order)."""
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, bytes):
+            h.update(part)
+        elif isinstance(part, str):
+            h.update(part.encode())
+        else:
+            h.update(json.dumps(part, sort_keys=True, default=str).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+def file_hash(path, chunk_size=1 << 20):
+    stat = os.stat(path)
+    stamp = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if stamp not in _file_hashes:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                h.update(chunk)
+        _file_hashes[stamp] = h.hexdigest()
+    return _file_hashes[stamp]
+
+def frame_hash(df):
+    """Hash of a frame's values, index and column labels."""
+    values = pd.util.hash_pandas_object(df, index=True).to_numpy()
+    return hash_parts(values.tobytes(), [list(map(str, col)) if isinstance(col, tuple) else str(col)
+        for col in df.columns])
+
+def code_version(*modules):
+    """Hash of the source files of the given modules (just the name for ones without a file)."""
+    return hash_parts(*[file_hash(module.__file__) if getattr(module, "__file__", None)
+        and os.path.exists(module.__file__) else module.__name__ for module in modules])
+
+
+class StageCache:
+    """
+    Results of one pipeline stage stored under processed_data/stage_cache/<stage>, one
+    frame per content key. A key changes whenever any of the inputs it was built from does.
+    """
+
+    def __init__(self, stage, cache_dir=CACHE_DIR):
+        self.stage = stage
+        self.dir = os.path.join(cache_dir, stage)
+
+    def key(self, *parts):
+        return hash_parts(self.stage, *parts)
+
+    def has(self, key):
+        return bool(available_formats(key, self.dir))
+
+    def load(self, key):
+        return read_frame(key, base_dir=self.dir)
+
+    def save(self, key, df):
+        write_frame(df, key, base_dir=self.dir)
+
+    def prune(self, keep):
+        """Removes entries whose key is not in keep."""
+        if not os.path.isdir(self.dir):
+            return
+        for entry in os.listdir(self.dir):
+            if entry.split(".")[0] not in keep:
+                path = os.path.join(self.dir, entry)
+                if os.path.isdir(path):
+                    for f in os.listdir(path):
+                        os.remove(os.path.join(path, f))
+                    os.rmdir(path)
+                else:
+                    os.remove(path)
+
+def load_manifest(cache_dir=CACHE_DIR):
+    path = os.path.join(cache_dir, "manifest.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(manifest, cache_dir=CACHE_DIR):
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=1)
+
+
+# ------------------------------
+# Pipeline runner
+# ------------------------------
+
+def run_groups_stage(cache_dir=CACHE_DIR, n_jobs=-1, backend="loky", batch_size=8):
+    """
+    data2 per option group. A group's key covers its filtered 9-column slice, the stored rates
+    and the code of data2/rates/timeseries/ingest; only groups without a cached result are sent
+    to run_group_frames. Returns {country: [(contract, group key) in file order]}, where
+    contract is the group's position in kovadata3 (the contract column of the frames).
+    """
+    cache = StageCache("groups", cache_dir)
+    base = hash_parts(rates.rates_version(), code_version(data2, rates, timeseries, ingest))
+    keys_by_country = {}
+    missed = []
+
+    def misses():
+        for contract, group in enumerate(ingest.iter_group_frames()):
+            group = data2.filter_option_group(group)
+            key = cache.key(base, frame_hash(group))
+            keys_by_country.setdefault(group.columns[0][2], []).append((contract, key))
+            if not cache.has(key) and key not in missed:
+                missed.append(key)
+                yield group
+
+    fresh = data2.run_group_frames(misses(), n_jobs=n_jobs, backend=backend, batch_size=batch_size)
+    for key, df in zip(missed, fresh):
+        cache.save(key, df)
+    print(f"groups: {len(missed)} recomputed, "
+        f"{sum(map(len, keys_by_country.values())) - len(missed)} from cache")
+    cache.prune({k for keys in keys_by_country.values() for _, k in keys})
+    return keys_by_country
+
+def run_pipeline(eep_stage=None, cache_dir=CACHE_DIR, n_jobs=-1, backend="loky",
+        batch_size=8, eep_method=eep.DEFAULT_EEP_METHOD):
+    """
+    Runs data2 -> per-country frames -> data3's FX index and recomputes only what changed.
+
+    Every partition is recorded in manifest.json with the key of its inputs:
+      - groups: see run_groups_stage
+      - country frames: the keys of their groups, eep.py's code and eep_method (or the code
+        of eep_stage's module when given)
+      - fx_index: the stored exchange rates and data3's code
+
+    eep_stage, when given, is applied to a country frame before it is written and must add
+    the EEP_call/EEP_put columns. Otherwise eep.add_eep with eep_method (one of
+    eep.EEP_METHODS, by default the one data2 uses) is; the method is part of the country
+    frames' key. Only with eep_method=None and no eep_stage are the frames written without
+    EEP and exported as CSV for calculate_eeps. Note that calculate_eeps rewrites all three
+    CSVs, so it should only be run after all of them have been rebuilt.
+
+    Returns the names of the partitions that were rebuilt.
+    """
+    rates.build_rate_store()
+    ingest.build_options_store()
+    manifest = load_manifest(cache_dir)
+    rebuilt = []
+
+    keys_by_country = run_groups_stage(cache_dir, n_jobs, backend, batch_size)
+    groups_cache = StageCache("groups", cache_dir)
+
+    # The EEP engines live in eep.py, so its code is part of the key however the stage is given.
+    if eep_stage is not None:
+        stage_module = inspect.getmodule(eep_stage)
+        eep_version = hash_parts(code_version(eep, *([stage_module] if stage_module else [])))
+    elif eep_method is not None:
+        eep_version = hash_parts(code_version(eep), eep_method)
+
+        def eep_stage(df):
+            return eep.add_eep(df, method=eep_method)
+    else:
+        eep_version = None
+    for country, name in COUNTRY_FRAMES.items():
+        key = hash_parts("country", keys_by_country.get(country, []), eep_version)
+        if manifest.get(name) == key and available_formats(name):
+            continue
+        frames = [groups_cache.load(k).assign(contract=c) for c, k in keys_by_country.get(country, [])]
+        df = pd.concat([f for f in frames if not f.empty])
+        if eep_stage is not None:
+            df = eep_stage(df)
+        write_frame(df, name, csv_export=eep_stage is None)
+        manifest[name] = key
+        rebuilt.append(name)
+
+    # SEK data is converted on read through the FX index (data3.read_converted and
+    # iter_converted), so only the index is built here, not a pooled frame.
+    fx_key = hash_parts("fx", data3.fx_version(EXCHANGE_RATES_PATH), code_version(data3))
+    if manifest.get('fx_index') != fx_key or not os.path.exists(data3.FX_INDEX_PATH):
+        data3.build_fx_index(data3.FX_INDEX_PATH, EXCHANGE_RATES_PATH, force=True)
+        manifest['fx_index'] = fx_key
+        rebuilt.append('fx_index')
+
+    save_manifest(manifest, cache_dir)
+    print("rebuilt:", rebuilt if rebuilt else "nothing")
+    return rebuilt
+
+
+# ------------------------------
+# Daily append mode
+# ------------------------------
+
+def contract_key(group):
+    """Stable id of a contract: a hash of its 9 column headers."""
+    return hash_parts([list(map(str, col)) for col in group.columns])
+
+def with_eep(df, eep_method):
+    return df if eep_method is None else eep.add_eep(df, method=eep_method)
+
+def load_append_index(state_dir=APPEND_DIR):
+    path = os.path.join(state_dir, "contracts.json")
+    if not os.path.exists(path):
+        return {'order': [], 'country': {}, 'eep_method': eep.DEFAULT_EEP_METHOD}
+    with open(path) as f:
+        return json.load(f)
+
+def save_append_index(index, state_dir=APPEND_DIR):
+    os.makedirs(state_dir, exist_ok=True)
+    with open(os.path.join(state_dir, "contracts.json"), "w") as f:
+        json.dump(index, f)
+
+def seed_append_state(state_dir=APPEND_DIR, n_jobs=-1, backend="loky", batch_size=8,
+        eep_method=eep.DEFAULT_EEP_METHOD):
+    """
+    Full data2 run over the options store, kept per contract (without EEP) as the starting
+    point for append_new_dates, and written out as the per-country frames with the EEP of
+    eep_method like run_pipeline writes them (None writes them without EEP, with CSV copies
+    for calculate_eeps). Every contract's rows carry their position in the country frame
+    (frame_row), so later appends can update them in place.
+    """
+    rates.build_rate_store()
+    ingest.build_options_store()
+    meta = ingest.read_store_meta()
+    results = data2.run_group_frames(ingest.iter_group_frames(), n_jobs=n_jobs, backend=backend,
+        batch_size=batch_size)
+    contracts = StageCache("contracts", state_dir)
+    index = {'order': [], 'country': {}, 'eep_method': eep_method}
+    frames = {}
+    for g, (contract, df) in enumerate(zip(meta['contracts'], results)):
+        key = hash_parts(contract['columns'])
+        country = contract['country']
+        start = sum(len(f) for f in frames.get(country, []))
+        df = df.assign(contract=g)
+        contracts.save(key, df.assign(frame_row=np.arange(start, start + len(df))))
+        if not df.empty:
+            frames.setdefault(country, []).append(df)
+        index['order'].append(key)
+        index['country'][key] = country
+    save_append_index(index, state_dir)
+    for country, dfs in frames.items():
+        write_frame(with_eep(pd.concat(dfs), eep_method), COUNTRY_FRAMES[country],
+            csv_export=eep_method is None)
+    return index
+
+def update_dividend_window(prev, new_rows, country):
+    """
+    Appends new_rows (already processed by process_option_group) to a contract's previous
+    rows. New dividends change PV_alldivs only for earlier rows whose maturity reaches past
+    them, so only the rows since (first new dividend - longest maturity) are recomputed and
+    their x is shifted by the change in PV_alldivs.
+    """
+    new_divs = new_rows.loc[new_rows['ulying_div'] != 0, 'Date']
+    if new_divs.empty:
+        return pd.concat([prev, new_rows], ignore_index=True)
+
+    reach = pd.Timedelta(days=int(np.ceil(prev['maturity'].max() * 365)))
+    affected = (prev['Date'] >= new_divs.min() - reach).to_numpy()
+    window = pd.concat([prev[affected], new_rows], ignore_index=True)
+    old_pv = window['PV_alldivs'].to_numpy()
+    window = data2.calculate_pv_alldivs_vectorized(window.drop(columns='PV_alldivs'), None, country,
+        rates.get_rate_curve(country))
+    window['x'] = window['x'] + old_pv - window['PV_alldivs'].to_numpy()
+    return pd.concat([prev[~affected], window], ignore_index=True)
+
+def append_new_dates(new_options, state_dir=APPEND_DIR):
+    """
+    Adds new trading days to the processed outputs without reprocessing the history.
+
+    new_options is a wide frame in the kovadata3 layout (e.g. from
+    ingest.read_wide_options on the day's file). The rate store is refreshed first, so the
+    day's rates are used. For every contract only the dates after its last processed date
+    are run through process_option_group; PV_alldivs (and x) of earlier rows is updated
+    only where a new dividend falls inside their window. The country frames written by
+    seed_append_state then get the new rows appended and the updated rows overwritten in
+    place (see frame_io.append_frame), so the cost of a day does not grow with the history.
+    Both get the EEP of the method the state was seeded with. CSV copies are removed rather
+    than rewritten, as they would no longer match.
+
+    Returns the number of new rows per country.
+    """
+    rates.build_rate_store()
+    rates._curves.clear()
+    index = load_append_index(state_dir)
+    contracts = StageCache("contracts", state_dir)
+    # A contract's id is its position in the order it was first seen, like data2's.
+    ids = {key: g for g, key in enumerate(index['order'])}
+    # Per country: (contract key, merged rows, rows before the append) of touched contracts.
+    touched = {}
+    for i in range(0, len(new_options.columns), 9):
+        group = new_options.iloc[:, i:i + 9]
+        key = contract_key(group)
+        country = group.columns[0][2]
+        prev = contracts.load(key) if contracts.has(key) else None
+        if prev is not None and not prev.empty:
+            group = group[group.index > prev['Date'].max()]
+        group = data2.filter_option_group(group)
+        if group.empty:
+            continue
+
+        if key not in ids:
+            ids[key] = len(index['order'])
+            index['order'].append(key)
+            index['country'][key] = country
+        new_rows = data2.process_option_group(0, group).assign(contract=ids[key])
+        if prev is None or prev.empty:
+            prev = new_rows.iloc[:0].assign(frame_row=np.empty(0, dtype=np.int64))
+            merged = new_rows
+        else:
+            merged = update_dividend_window(prev, new_rows, country)
+        touched.setdefault(country, []).append((key, merged, prev))
+
+    added = {}
+    for country, entries in touched.items():
+        appended, updated = [], []
+        for key, merged, prev in entries:
+            old = merged.iloc[:len(prev)]
+            changed = (old['PV_alldivs'].to_numpy() != prev['PV_alldivs'].to_numpy())
+            updated.append(old[changed].set_index(prev['frame_row'].to_numpy(dtype=np.int64)[changed]))
+            appended.append(merged.iloc[len(prev):])
+        columns = [c for c in merged.columns if c != 'frame_row']
+        method = index.get('eep_method')
+        positions = append_frame(with_eep(pd.concat(appended)[columns], method),
+            COUNTRY_FRAMES[country], updates=with_eep(pd.concat(updated)[columns], method))
+        start = 0
+        for (key, merged, prev), rows in zip(entries, appended):
+            merged = merged.reset_index(drop=True)
+            merged.loc[len(prev):, 'frame_row'] = positions[start:start + len(rows)]
+            contracts.save(key, merged.astype({'frame_row': np.int64}))
+            start += len(rows)
+        added[country] = len(positions)
+
+    save_append_index(index, state_dir)
+    print("appended rows:", added)
+    return added
+
+
+if __name__ == "__main__":
+    run_pipeline()
@@ -0,0 +1,155 @@
+import numpy as np
+
+from frame_io import iter_frame
+
+# ------------------------------
+# Mergeable quantile sketch and chunked winsorization
+# ------------------------------
+
+DEFAULT_EPS = 0.001
+
+
+def kll_k(eps):
+    """
+    Compactor size giving a normalized rank error of eps (with ~99 % confidence), from the
+    empirical fit eps = 2.296 / k^0.9723 of the Apache DataSketches KLL sketch.
+    """
+    return max(8, int(np.ceil((2.296 / eps) ** (1 / 0.9723))))
+
+
+class QuantileSketch:
+    """
+    KLL quantile sketch of a stream of floats.
+
+    Items live in a hierarchy of compactors; an item at level h stands for 2^h values. When a
+    level outgrows its capacity (k at the top, shrinking by 2/3 per level below) it is sorted
+    and every other item, starting at a random offset, moves up a level. Memory is O(k) and
+    the rank error of any quantile is about eps * n. Sketches of different chunks, partitions
+    or countries merge into the sketch of their union.
+
+    eps=0 is the exact mode: every value is kept and quantile() is the same linear
+    interpolation as Series.quantile. Use it for data that fits in memory. A sketch that has
+    seen at most k values has not compacted anything yet and is exact as well.
+    """
+
+    def __init__(self, eps=DEFAULT_EPS, seed=None):
+        self.eps = eps
+        self.k = kll_k(eps) if eps > 0 else None
+        self.rng = np.random.default_rng(seed)
+        self.levels = [np.empty(0)]
+        self.n = 0
+
+    def capacity(self, level):
+        depth = len(self.levels) - 1 - level
+        return max(2, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def update(self, values):
+        """Adds an array of values; NaNs are skipped like Series.quantile does."""
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.n += len(values)
+        self._compress()
+        return self
+
+    def _compress(self):
+        if self.k is None:
+            return
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(items)
+                # An odd item out stays on this level.
+                keep = items[len(items) - len(items) % 2:]
+                pairs = items[:len(items) - len(items) % 2]
+                promoted = pairs[self.rng.integers(2)::2]
+                self.levels[level] = keep
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+            level += 1
+
+    def merge(self, other):
+        """A new sketch of both streams; the coarser accuracy of the two is kept."""
+        merged = QuantileSketch(max(self.eps, other.eps), self.rng.integers(2**32))
+        if merged.k is None:
+            merged.levels = [np.concatenate(self.levels + other.levels)]
+        else:
+            depth = max(len(self.levels), len(other.levels))
+            merged.levels = [np.concatenate([s.levels[h] * 1.0 for s in (self, other) if h < len(s.levels)])
+                for h in range(depth)]
+        merged.n = self.n + other.n
+        merged._compress()
+        return merged
+
+    __add__ = merge
+
+    def _weighted_items(self):
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(v), 2.0**h) for h, v in enumerate(self.levels)])
+        order = np.argsort(items, kind="stable")
+        return items[order], np.cumsum(weights[order])
+
+    def quantile(self, q):
+        """Value at quantile(s) q; NaN for an empty sketch."""
+        if self.n == 0:
+            return np.full(np.shape(q), np.nan) if np.ndim(q) else np.nan
+        if len(self.levels) == 1:
+            # Nothing has been compacted yet, so the answer is exact.
+            return np.quantile(self.levels[0], q)
+        items, cumulative = self._weighted_items()
+        # The item whose weighted rank is closest above q * (n - 1), matching the exact mode.
+        target = np.asarray(q, dtype=float) * (cumulative[-1] - 1)
+        idx = np.minimum(np.searchsorted(cumulative, target, side="right"), len(items) - 1)
+        return items[idx]
+
+    def rank(self, value):
+        """Estimated number of values strictly below value."""
+        if len(self.levels) == 1:
+            return np.count_nonzero(self.levels[0] < value)
+        items, cumulative = self._weighted_items()
+        idx = np.searchsorted(items, value, side="left")
+        return np.where(idx > 0, cumulative[np.maximum(idx - 1, 0)], 0.0)
+
+    @property
+    def size(self):
+        """Number of items held."""
+        return sum(len(v) for v in self.levels)
+
+
+# ------------------------------
+# Two-pass chunked winsorization of y - x
+# ------------------------------
+
+def _chunks(name, columns, chunk_size):
+    return iter_frame(name, columns=['x', 'y', *columns], chunk_size=chunk_size)
+
+def sketch_errors(name, where=None, columns=(), eps=DEFAULT_EPS, chunk_size=1_000_000, seed=0):
+    """
+    Pass one: QuantileSketch of y - x over a processed frame, read chunk_size rows at a time.
+    where, given, is called on each chunk (with x, y and columns) and returns the rows to
+    keep, e.g. data4's volume filter.
+    """
+    sketch = QuantileSketch(eps, seed)
+    for chunk in _chunks(name, columns, chunk_size):
+        if where is not None:
+            chunk = chunk[where(chunk)]
+        sketch.update((chunk['y'] - chunk['x']).to_numpy())
+    return sketch
+
+def winsor_bounds(sketch, winsor_pct):
+    lower, upper = sketch.quantile([winsor_pct, 1 - winsor_pct])
+    return lower, upper
+
+def iter_winsorized(name, lower, upper, where=None, columns=(), chunk_size=1_000_000):
+    """
+    Pass two: the chunks of the frame with where applied and the rows whose error is outside
+    [lower, upper] dropped, like winsorize_errors (rows with a NaN error are kept). No
+    error or flag column is added to the frame.
+    """
+    for chunk in _chunks(name, columns, chunk_size):
+        if where is not None:
+            chunk = chunk[where(chunk)]
+        error = chunk['y'] - chunk['x']
+        yield chunk[~((error < lower) | (error > upper))]
@@ -0,0 +1,209 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from timeseries import SERIES_DB_PATH, SeriesStore, import_csv_once
+
+# ------------------------------
+# Risk-free rate curves
+# ------------------------------
+
+RATES_PATH = "unprocessed_data/risk_free_rates2.csv"
+RATE_STORE_DIR = "processed_data/rate_store"
+
+# Tenor (in days) -> column in risk_free_rates2.csv for each country.
+RATE_MAPPINGS = {
+    "NORWAY": {
+        1: "NOKONZ=R",
+        7: "OINOKSWD=",
+        30: "OINOK1MD=",
+        60: "OINOK2MD=",
+        90: "OINOK3MD=",
+        180: "OINOK6MD=",
+        270: "NOK9MZ=R",
+        365: "NOK1YZ=R",
+        455: "NOK1Y3MZ=R"
+    },
+    "SWEDEN": {
+        1: "STISEKTNDFI=",
+        7: "STISEK1WDFI=",
+        30: "STISEK1MDFI=",
+        60: "STISEK2MDFI=",
+        90: "STISEK3MDFI=",
+        180: "STISEK6MDFI=",
+        270: "SEK9MZ=R",
+        365: "SEGOV1YZ=R",
+        455: "SEGOV1Y3MZ=R"
+    },
+    "DENMARK": {
+        1: "DKKONZ=R",
+        7: "CIDKKSWD=",
+        30: "CIDKK1MD=",
+        60: "DKK2MZ=R",
+        90: "DKK9MZ=R",
+        180: "CIDKK6MD=",
+        270: "DKK9MZ=R",
+        365: "CIDKK1YD=",
+        455: "DKKABQCD1Y3MZ=R"
+    },
+}
+
+# Every series RATE_MAPPINGS refers to.
+RATE_SERIES = sorted({ric for mapping in RATE_MAPPINGS.values() for ric in mapping.values()})
+
+def get_rate_mapping(country):
+    mapping = RATE_MAPPINGS.get(country.upper())
+    if mapping is None:
+        raise ValueError("Country not recognized. Use 'NORWAY', 'SWEDEN', or 'DENMARK'.")
+    return mapping
+
+def to_day_numbers(dates):
+    # Whole days since the epoch; the time of day is dropped like dates.normalize() does.
+    return np.asarray(pd.DatetimeIndex(dates).values.astype("datetime64[D]").astype(np.int64))
+
+def filled_tenor_rates(rates_df, mapping):
+    """
+    Returns (tenors, rates) where rates is a (date x tenor) array in the order of the sorted
+    mapping keys. A missing rate is replaced by the nearest longer tenor that has one, and
+    failing that by the nearest shorter one, exactly like get_rate_for_maturity.
+    """
+    tenors = np.array(sorted(mapping.keys()), dtype=float)
+    nan_col = np.full(len(rates_df), np.nan)
+    raw = pd.DataFrame(np.column_stack([
+        rates_df[mapping[m]].to_numpy(dtype=float) if mapping[m] in rates_df.columns else nan_col
+        for m in sorted(mapping.keys())
+    ]))
+    return tenors, raw.bfill(axis=1).ffill(axis=1).to_numpy()
+
+def interpolate_tenor_rates(tenors, curve_rows, T_days):
+    """
+    Linear interpolation of each row of curve_rows at its own T_days, clamped to the shortest
+    and longest tenor. Matches get_interpolated_rate on a filled row.
+    """
+    upper = np.clip(np.searchsorted(tenors, T_days, side="left"), 1, len(tenors) - 1)
+    lower = upper - 1
+    frac = np.clip((T_days - tenors[lower]) / (tenors[upper] - tenors[lower]), 0.0, 1.0)
+    rows = np.arange(len(T_days))
+    r_lower = curve_rows[rows, lower]
+    r_upper = curve_rows[rows, upper]
+    return r_lower + (r_upper - r_lower) * frac
+
+
+class RateCurve:
+    """
+    Risk-free curve of one country, built once from risk_free_rates2.csv.
+
+    Holds a dense (date x tenor) array of rates in decimals with the nearest-tenor fill
+    already applied, so a query for whole arrays of (date, days) is one asof searchsorted
+    plus one linear interpolation.
+    """
+
+    def __init__(self, days, tenors, rates, country=None):
+        self.days = np.asarray(days, dtype=np.int64)
+        self.tenors = np.asarray(tenors, dtype=float)
+        self.rates = rates
+        self.country = country
+
+    @classmethod
+    def from_frame(cls, rates_df, country):
+        """rates_df is indexed by Date with rates in percent, as in the CSV."""
+        rates_df = rates_df.sort_index()
+        tenors, curve = filled_tenor_rates(rates_df / 100, get_rate_mapping(country))
+        return cls(to_day_numbers(rates_df.index), tenors, curve, country.upper())
+
+    @classmethod
+    def from_csv(cls, country, path=RATES_PATH):
+        """From the series store (see read_rates) that path is imported into."""
+        return cls.from_frame(read_rates(path), country)
+
+    @classmethod
+    def load(cls, country, store_dir=RATE_STORE_DIR, mmap_mode="r"):
+        """Attaches to a curve written by build_rate_store; the arrays are memory-mapped."""
+        prefix = os.path.join(store_dir, country.lower())
+        return cls(
+            np.load(os.path.join(store_dir, "days.npy"), mmap_mode=mmap_mode),
+            np.load(prefix + "_tenors.npy"),
+            np.load(prefix + "_rates.npy", mmap_mode=mmap_mode),
+            country.upper(),
+        )
+
+    def positions(self, dates):
+        """Row of the last observation on or before each date; -1 before the first one."""
+        return np.searchsorted(self.days, to_day_numbers(dates), side="right") - 1
+
+    def rate_at(self, positions, T_days):
+        """Interpolated rate for T_days on the given rows; NaN where the row is -1."""
+        positions = np.asarray(positions)
+        T_days = np.asarray(T_days, dtype=float)
+        rates = interpolate_tenor_rates(self.tenors, self.rates[np.maximum(positions, 0)], T_days)
+        return np.where(positions >= 0, rates, np.nan)
+
+    def rate(self, dates, T_days):
+        """Interpolated rate as of each date for the matching T_days (in days)."""
+        return self.rate_at(self.positions(dates), T_days)
+
+
+# ------------------------------
+# Process-wide rate store
+# ------------------------------
+
+# Curves this process has already attached to, keyed by (store_dir, country).
+_curves = {}
+
+def read_rates(path=RATES_PATH, db_path=SERIES_DB_PATH, known_at=None):
+    """
+    The rates (in percent, one column per RIC, forward filled like the downloads were) from
+    the series store; risk_free_rates2.csv at path is imported into it first if it changed.
+    known_at reads the rates as they were stored at that time.
+    """
+    import_csv_once(path, db_path)
+    with SeriesStore(db_path) as store:
+        return store.frame(RATE_SERIES, known_at).ffill()
+
+def rates_version(path=RATES_PATH, db_path=SERIES_DB_PATH):
+    """Changes whenever the stored rates do."""
+    import_csv_once(path, db_path)
+    with SeriesStore(db_path) as store:
+        return store.version(RATE_SERIES)
+
+def build_rate_store(path=RATES_PATH, store_dir=RATE_STORE_DIR, force=False, db_path=SERIES_DB_PATH):
+    """
+    Reads the rates once (see read_rates) and writes every country's filled curve as .npy
+    files under store_dir, so worker processes can memory-map them instead of each querying
+    the series store or receiving a pickled rates frame. Nothing is done while the store
+    was built from the current rates.
+    """
+    marker = os.path.join(store_dir, "days.npy")
+    version_path = os.path.join(store_dir, "version.json")
+    version = rates_version(path, db_path)
+    if not force and os.path.exists(marker) and os.path.exists(version_path):
+        with open(version_path) as f:
+            if json.load(f) == version:
+                return store_dir
+    os.makedirs(store_dir, exist_ok=True)
+    rates_df = read_rates(path, db_path)
+    for country in RATE_MAPPINGS:
+        curve = RateCurve.from_frame(rates_df, country)
+        prefix = os.path.join(store_dir, country.lower())
+        np.save(prefix + "_tenors.npy", curve.tenors)
+        np.save(prefix + "_rates.npy", np.ascontiguousarray(curve.rates))
+    # The shared date index is written last, so its presence marks a complete store.
+    np.save(marker, to_day_numbers(rates_df.index))
+    with open(version_path, "w") as f:
+        json.dump(version, f)
+    _curves.clear()
+    return store_dir
+
+def get_rate_curve(country, store_dir=RATE_STORE_DIR):
+    """
+    The country's RateCurve for this process. The first call attaches to the memory-mapped
+    store (building it if it does not exist yet); later calls return the same object.
+    """
+    key = (store_dir, country.upper())
+    if key not in _curves:
+        if not os.path.exists(os.path.join(store_dir, "days.npy")):
+            build_rate_store(store_dir=store_dir)
+        _curves[key] = RateCurve.load(country, store_dir)
+    return _curves[key]
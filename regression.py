@@ -0,0 +1,394 @@
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+from scipy import stats
+
+from frame_io import iter_frame
+
+# ------------------------------
+# Streaming OLS of y on a constant and x
+# ------------------------------
+
+
+class OLSAccumulator:
+    """
+    Sufficient statistics of the regression y = a + b x, fed in chunks and mergeable across
+    partitions and countries.
+
+    They are kept as the count, the means and the centered second moments (Cxx, Cxy, Cyy)
+    rather than raw power sums, so merging (Chan et al.) does not lose precision to
+    cancellation; sums() gives the equivalent n, sum x, sum y, sum x^2, sum xy, sum y^2.
+    The coefficients, standard errors and R^2 are those of sm.OLS(y, add_constant(x)).
+    """
+
+    def __init__(self, n=0, mean_x=0.0, mean_y=0.0, cxx=0.0, cxy=0.0, cyy=0.0):
+        self.n = n
+        self.mean_x = mean_x
+        self.mean_y = mean_y
+        self.cxx = cxx
+        self.cxy = cxy
+        self.cyy = cyy
+
+    @classmethod
+    def from_sums(cls, n, sum_x, sum_y, sum_xx, sum_xy, sum_yy):
+        """From raw power sums; best on data already shifted close to its mean."""
+        if n == 0:
+            return cls()
+        mean_x, mean_y = sum_x / n, sum_y / n
+        return cls(n, mean_x, mean_y, sum_xx - n * mean_x**2, sum_xy - n * mean_x * mean_y,
+            sum_yy - n * mean_y**2)
+
+    def shifted(self, dx, dy):
+        """The statistics of (x + dx, y + dy)."""
+        return OLSAccumulator(self.n, self.mean_x + dx, self.mean_y + dy, self.cxx, self.cxy,
+            self.cyy)
+
+    @classmethod
+    def from_arrays(cls, x, y):
+        """Statistics of one chunk; pairs where x or y is NaN are left out."""
+        x = np.asarray(x, dtype=float)
+        y = np.asarray(y, dtype=float)
+        keep = ~(np.isnan(x) | np.isnan(y))
+        x, y = x[keep], y[keep]
+        if len(x) == 0:
+            return cls()
+        dx = x - x.mean()
+        dy = y - y.mean()
+        return cls(len(x), x.mean(), y.mean(), dx @ dx, dx @ dy, dy @ dy)
+
+    def merge(self, other):
+        """The statistics of both partitions together."""
+        if other.n == 0:
+            return OLSAccumulator(self.n, self.mean_x, self.mean_y, self.cxx, self.cxy, self.cyy)
+        if self.n == 0:
+            return other.merge(self)
+        n = self.n + other.n
+        delta_x = other.mean_x - self.mean_x
+        delta_y = other.mean_y - self.mean_y
+        weight = self.n * other.n / n
+        return OLSAccumulator(
+            n,
+            self.mean_x + delta_x * other.n / n,
+            self.mean_y + delta_y * other.n / n,
+            self.cxx + other.cxx + delta_x * delta_x * weight,
+            self.cxy + other.cxy + delta_x * delta_y * weight,
+            self.cyy + other.cyy + delta_y * delta_y * weight,
+        )
+
+    __add__ = merge
+
+    def update(self, x, y):
+        """Adds a chunk in place and returns self."""
+        merged = self.merge(OLSAccumulator.from_arrays(x, y))
+        self.__dict__.update(merged.__dict__)
+        return self
+
+    def sums(self):
+        n = self.n
+        return {
+            'n': n,
+            'sum_x': n * self.mean_x,
+            'sum_y': n * self.mean_y,
+            'sum_xx': self.cxx + n * self.mean_x**2,
+            'sum_xy': self.cxy + n * self.mean_x * self.mean_y,
+            'sum_yy': self.cyy + n * self.mean_y**2,
+        }
+
+    @property
+    def params(self):
+        """[const, slope] like model.params."""
+        slope = self.cxy / self.cxx
+        return np.array([self.mean_y - slope * self.mean_x, slope])
+
+    @property
+    def ssr(self):
+        return self.cyy - self.cxy**2 / self.cxx
+
+    @property
+    def df_resid(self):
+        return self.n - 2
+
+    @property
+    def bse(self):
+        """Non-robust standard errors of [const, slope], as in model.bse."""
+        sigma2 = self.ssr / self.df_resid
+        return np.sqrt(sigma2 * np.array([1 / self.n + self.mean_x**2 / self.cxx, 1 / self.cxx]))
+
+    @property
+    def tvalues(self):
+        return self.params / self.bse
+
+    @property
+    def pvalues(self):
+        return 2 * stats.t.sf(np.abs(self.tvalues), self.df_resid)
+
+    @property
+    def rsquared(self):
+        return 1 - self.ssr / self.cyy
+
+    def summary(self, alpha=0.05):
+        """The coefficient table of model.summary() plus n and R^2 as a DataFrame."""
+        q = stats.t.ppf(1 - alpha / 2, self.df_resid)
+        table = pd.DataFrame({
+            'coef': self.params,
+            'std err': self.bse,
+            't': self.tvalues,
+            'P>|t|': self.pvalues,
+            f'[{alpha / 2}': self.params - q * self.bse,
+            f'{1 - alpha / 2}]': self.params + q * self.bse,
+        }, index=['const', 'x'])
+        table.attrs = {'n': self.n, 'rsquared': self.rsquared}
+        return table
+
+    def __repr__(self):
+        return (f"OLSAccumulator(n={self.n}, params={self.params.tolist()}, "
+            f"rsquared={self.rsquared:.6f})") if self.n > 2 else f"OLSAccumulator(n={self.n})"
+
+
+def accumulate_frame(name, where=None, columns=(), scale=None, chunk_size=1_000_000):
+    """
+    OLSAccumulator of y on x over a processed frame, fed chunk_size rows at a time. where,
+    given, is called on each chunk (with x, y and columns) and returns the rows to keep;
+    scale, given, maps a chunk to a factor applied to both x and y (e.g. an exchange rate).
+    """
+    acc = OLSAccumulator()
+    for chunk in iter_frame(name, columns=['x', 'y', *columns], chunk_size=chunk_size):
+        if where is not None:
+            chunk = chunk[where(chunk)]
+        factor = 1.0 if scale is None else scale(chunk)
+        acc.update(chunk['x'] * factor, chunk['y'] * factor)
+    return acc
+
+
+# ------------------------------
+# Filter threshold sweep
+# ------------------------------
+
+class _SumTree:
+    """
+    Fenwick tree of the six regression sums over positions (rows in error order), so rows
+    can be added in batches and the sums of any prefix, or the position of the k-th present
+    row, are found in O(log n).
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.tree = np.zeros((size + 1, 6))
+
+    def add(self, positions, values):
+        idx = np.asarray(positions) + 1
+        values = np.asarray(values)
+        while len(idx):
+            np.add.at(self.tree, idx, values)
+            idx = idx + (idx & -idx)
+            keep = idx <= self.size
+            idx, values = idx[keep], values[keep]
+
+    def prefix(self, end):
+        """Sums over positions [0, end)."""
+        total = np.zeros(6)
+        while end > 0:
+            total += self.tree[end]
+            end -= end & -end
+        return total
+
+    def kth(self, k):
+        """Position of the k-th (0-based) present row."""
+        pos = 0
+        step = 1 << self.size.bit_length()
+        while step:
+            nxt = pos + step
+            if nxt <= self.size and self.tree[nxt, 0] <= k:
+                pos = nxt
+                k -= self.tree[nxt, 0]
+            step >>= 1
+        return pos
+
+
+def sweep_filters(df, min_vols, winsor_pcts, max_illiquidities=(None,)):
+    """
+    OLS of y on x for every combination of data4's filters: drop_low_volume(min_vol),
+    dropilliquid(max_illiquidity) (None means not applied) and winsorize_errors(winsor_pct),
+    applied in that order.
+
+    For each illiquidity level the rows are ordered by error once and sorted by their
+    smallest volume. Lowering min_vol then only adds rows to a Fenwick tree of regression
+    sums, and each winsor_pct needs two order-statistic lookups for the pandas quantiles
+    plus two prefix queries. Returns one row per grid point with n, intercept, slope, their
+    standard errors and R^2.
+    """
+    df = df.dropna(subset=['x', 'y'])
+    # Shift to the sample means so the power sums in the tree stay well conditioned.
+    shift_x, shift_y = df['x'].mean(), df['y'].mean()
+    x = df['x'].to_numpy() - shift_x
+    y = df['y'].to_numpy() - shift_y
+    error = df['y'].to_numpy() - df['x'].to_numpy()
+    volume = df[['call_v', 'put_v', 'ulying_volume']].min(axis=1, skipna=False).fillna(-np.inf).to_numpy()
+    rows = []
+    for level, max_ill in enumerate(max_illiquidities):
+        if max_ill is None:
+            subset = np.arange(len(df))
+        else:
+            illiquidity = df[['ulying_illiquidity', 'call_illiquidity', 'put_illiquidity']].max(
+                axis=1, skipna=False).fillna(np.inf).to_numpy()
+            subset = np.flatnonzero(illiquidity <= max_ill)
+        by_error = subset[np.argsort(error[subset], kind="stable")]
+        sorted_error = error[by_error]
+        position = np.empty(len(df), dtype=np.int64)
+        position[by_error] = np.arange(len(by_error))
+        stats_rows = np.column_stack([np.ones(len(df)), x, y, x * x, x * y, y * y])
+
+        tree = _SumTree(len(by_error))
+        by_volume = subset[np.argsort(-volume[subset], kind="stable")]
+        added = 0
+        for min_vol in sorted(min_vols, reverse=True):
+            new = np.searchsorted(-volume[by_volume], -min_vol, side="right")
+            batch = by_volume[added:new]
+            tree.add(position[batch], stats_rows[batch])
+            added = new
+            for pct in winsor_pcts:
+                stats_kept = np.zeros(6)
+                if added > 0:
+                    lo_q = _tree_quantile(tree, sorted_error, added, pct)
+                    hi_q = _tree_quantile(tree, sorted_error, added, 1 - pct)
+                    stats_kept = (tree.prefix(np.searchsorted(sorted_error, hi_q, side="right"))
+                        - tree.prefix(np.searchsorted(sorted_error, lo_q, side="left")))
+                acc = OLSAccumulator.from_sums(int(round(stats_kept[0])), *stats_kept[1:])
+                row = {'level': level, 'max_illiquidity': max_ill, 'min_vol': min_vol,
+                    'winsor_pct': pct, 'n': acc.n}
+                if acc.n > 2:
+                    acc = acc.shifted(shift_x, shift_y)
+                    row.update({'intercept': acc.params[0], 'slope': acc.params[1],
+                        'se_intercept': acc.bse[0], 'se_slope': acc.bse[1],
+                        'rsquared': acc.rsquared})
+                rows.append(row)
+    # The grid is walked from the highest min_vol down; report it in ascending order.
+    table = pd.DataFrame(rows).sort_values(['level', 'min_vol'], kind="stable")
+    return table.drop(columns='level').reset_index(drop=True)
+
+def _tree_quantile(tree, sorted_error, n, q):
+    # Series.quantile's linear interpolation between the order statistics of the present rows.
+    h = (n - 1) * q
+    lower = int(np.floor(h))
+    value = sorted_error[tree.kth(lower)]
+    if h > lower:
+        value = value + (h - lower) * (sorted_error[tree.kth(lower + 1)] - value)
+    return value
+
+
+# ------------------------------
+# Robust and bootstrapped standard errors
+# ------------------------------
+
+def date_sums(df):
+    """
+    (dates, sums, shift): the six regression sums of every date (n, x, y, xx, xy, yy) as a
+    (date x 6) array, computed on x and y shifted by their sample means (shift), with the
+    dates in order. Rows where x or y is NaN are left out.
+    """
+    df = df.dropna(subset=['x', 'y'])
+    shift = (df['x'].mean(), df['y'].mean())
+    x = df['x'].to_numpy() - shift[0]
+    y = df['y'].to_numpy() - shift[1]
+    codes, dates = pd.factorize(df['Date'], sort=True)
+    sums = np.column_stack([
+        np.bincount(codes, weights=w, minlength=len(dates))
+        for w in (np.ones(len(x)), x, y, x * x, x * y, y * y)
+    ])
+    return dates, sums, shift
+
+def params_from_sums(sums):
+    """[intercept, slope] for every row of a (... x 6) array of regression sums."""
+    n, sx, sy, sxx, sxy = (sums[..., k] for k in range(5))
+    slope = (sxy - sx * sy / n) / (sxx - sx * sx / n)
+    return np.stack([(sy - slope * sx) / n, slope], axis=-1)
+
+def block_weights(rng, n_dates, n_resamples, block_length):
+    """
+    How many times each date is drawn in each of n_resamples moving block bootstrap samples:
+    blocks of block_length consecutive dates with uniform random starts, until n_dates dates
+    are drawn (the last block is cut short). With fewer than block_length dates, every
+    sample is one block of all of them.
+    """
+    if n_dates < 1:
+        raise ValueError("The block bootstrap needs at least one date.")
+    block_length = min(block_length, n_dates)
+    n_blocks = -(-n_dates // block_length)
+    starts = rng.integers(0, n_dates - block_length + 1, size=(n_resamples, n_blocks))
+    drawn = (starts[:, :, None] + np.arange(block_length)).reshape(n_resamples, -1)[:, :n_dates]
+    flat = (drawn + np.arange(n_resamples)[:, None] * n_dates).ravel()
+    return np.bincount(flat, minlength=n_resamples * n_dates).reshape(n_resamples, n_dates).astype(float)
+
+def _bootstrap_chunk(sums, n_resamples, block_length, seed):
+    weights = block_weights(np.random.default_rng(seed), len(sums), n_resamples, block_length)
+    return params_from_sums(weights @ sums)
+
+def block_bootstrap(df, n_resamples=1000, block_length=5, n_jobs=-1, seed=0, chunk_size=250):
+    """
+    Moving block bootstrap over dates of the regression y = a + b x. A resample is a weight
+    per date, so its fit is one (weights x date sums) product instead of a refit on the
+    rows; chunks of chunk_size resamples run in a joblib process pool. Every chunk gets its
+    own child of SeedSequence(seed), so the draws depend only on seed and chunk_size, not
+    on n_jobs.
+
+    Returns the (n_resamples x 2) array of [intercept, slope] draws.
+    """
+    _, sums, shift = date_sums(df)
+    sizes = [min(chunk_size, n_resamples - start) for start in range(0, n_resamples, chunk_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    draws = Parallel(n_jobs=n_jobs)(
+        delayed(_bootstrap_chunk)(sums, size, block_length, s) for size, s in zip(sizes, seeds)
+    )
+    draws = np.concatenate(draws)
+    # Undo the shift: y + sy = a + b (x + sx)  =>  a = a' + sy - b sx.
+    draws[:, 0] += shift[1] - draws[:, 1] * shift[0]
+    return draws
+
+def robust_errors(df, maxlags=None, n_resamples=0, block_length=5, n_jobs=-1, seed=0):
+    """
+    Standard errors of [intercept, slope] for one country's regression: the OLS ones,
+    clustered by date, Driscoll-Kraay (Newey-West with Bartlett weights on the per-date sums
+    of the scores, i.e. HAC for a panel observed by date) and, when n_resamples > 0, the
+    date block bootstrap. They match statsmodels' cov_type 'nonrobust', 'cluster' (groups
+    = dates) and 'hac-groupsum' (time = dates). maxlags defaults to floor(4 (T/100)^(2/9))
+    for T dates.
+    """
+    df = df.dropna(subset=['x', 'y'])
+    acc = OLSAccumulator.from_arrays(df['x'], df['y'])
+    x = df['x'].to_numpy()
+    resid = df['y'].to_numpy() - acc.params[0] - acc.params[1] * x
+    codes, dates = pd.factorize(df['Date'], sort=True)
+    n, n_dates = len(x), len(dates)
+    # Scores X'e summed per date, (date x 2).
+    scores = np.column_stack([np.bincount(codes, weights=resid, minlength=n_dates),
+        np.bincount(codes, weights=x * resid, minlength=n_dates)])
+    xtx_inv = np.linalg.inv(np.array([[n, x.sum()], [x.sum(), x @ x]]))
+
+    def sandwich(meat):
+        return np.sqrt(np.diag(xtx_inv @ meat @ xtx_inv))
+
+    # statsmodels' small sample correction for both the cluster and the groupsum HAC errors.
+    correction = np.sqrt(n_dates / (n_dates - 1) * (n - 1) / (n - 2))
+    cluster = sandwich(scores.T @ scores) * correction
+
+    if maxlags is None:
+        maxlags = int(np.floor(4 * (n_dates / 100) ** (2 / 9)))
+    meat = scores.T @ scores
+    for lag in range(1, maxlags + 1):
+        gamma = scores[lag:].T @ scores[:-lag]
+        meat += (1 - lag / (maxlags + 1)) * (gamma + gamma.T)
+    driscoll_kraay = sandwich(meat) * correction
+
+    errors = pd.DataFrame({
+        'coef': acc.params,
+        'se_ols': acc.bse,
+        'se_cluster_date': cluster,
+        'se_driscoll_kraay': driscoll_kraay,
+    }, index=['const', 'x'])
+    if n_resamples > 0:
+        draws = block_bootstrap(df, n_resamples, block_length, n_jobs, seed)
+        errors['se_bootstrap'] = draws.std(axis=0, ddof=1)
+        errors['boot_2.5%'] = np.percentile(draws, 2.5, axis=0)
+        errors['boot_97.5%'] = np.percentile(draws, 97.5, axis=0)
+    errors.attrs = {'maxlags': maxlags, 'dates': n_dates, 'block_length': block_length}
+    return errors
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+from joblib import Parallel, delayed
+
+# ------------------------------
+# Headless, density-aggregated batch rendering
+# ------------------------------
+#
+# Figures are described by specs: plain dicts with the kind of figure, its labels and the
+# path of a small .npz of binned data in RENDER_CACHE_DIR. The binning is done once, in the
+# calling process, and the cached aggregates are keyed by the data they were made from, so a
+# restyled figure (see rerender) never goes back to the observations. Rendering draws on an
+# Agg canvas in joblib worker processes and writes the files; nothing is shown.
+
+RENDER_CACHE_DIR = "processed_data/render_cache"
+MANIFEST = "figures.json"
+DENSITY_BINS = 300
+
+
+def aggregate_key(*parts):
+    """sha256 over arrays (by their bytes) and JSON-able parameters."""
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            h.update(str(part.dtype).encode())
+            h.update(np.ascontiguousarray(part).tobytes())
+        else:
+            h.update(json.dumps(part, default=str).encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+def cached_aggregate(kind, parts, compute, cache_dir=RENDER_CACHE_DIR):
+    """Path of the .npz of compute() for parts; computed and written only if not cached."""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, f"{kind}_{aggregate_key(kind, *parts)[:32]}.npz")
+    if not os.path.exists(path):
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, **compute())
+        os.replace(tmp, path)
+    return path
+
+def density_bins(x, y, bins=DENSITY_BINS, extent=None):
+    """
+    Counts of the (x, y) points on a bins x bins raster over extent (x0, x1, y0, y1), rows
+    being y. Without extent the range of the finite points is used; points outside a given
+    extent are left out.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    keep = np.isfinite(x) & np.isfinite(y)
+    x, y = x[keep], y[keep]
+    if extent is None:
+        extent = (x.min(), x.max(), y.min(), y.max()) if len(x) else (0.0, 1.0, 0.0, 1.0)
+    x0, x1, y0, y1 = map(float, extent)
+    x1 = x1 if x1 > x0 else x0 + 1.0
+    y1 = y1 if y1 > y0 else y0 + 1.0
+    inside = (x >= x0) & (x <= x1) & (y >= y0) & (y <= y1)
+    ix = np.minimum(((x[inside] - x0) * (bins / (x1 - x0))).astype(np.int64), bins - 1)
+    iy = np.minimum(((y[inside] - y0) * (bins / (y1 - y0))).astype(np.int64), bins - 1)
+    counts = np.bincount(iy * bins + ix, minlength=bins * bins).reshape(bins, bins)
+    return {'counts': counts, 'extent': np.array([x0, x1, y0, y1])}
+
+def histogram_bins(values, bins=60):
+    values = np.asarray(values, dtype=float)
+    counts, edges = np.histogram(values[np.isfinite(values)], bins=bins)
+    return {'counts': counts, 'edges': edges}
+
+
+# ------------------------------
+# Figure specs
+# ------------------------------
+
+def density_spec(x, y, path, title, xlabel, ylabel, lines=(), bins=DENSITY_BINS,
+        cache_dir=RENDER_CACHE_DIR):
+    """
+    Density raster of a scatter plot. lines are (intercept, slope, color, label, linestyle)
+    drawn over it, e.g. a regression fit and y = x.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    data = cached_aggregate("density", (x, y, bins), lambda: density_bins(x, y, bins), cache_dir)
+    return {'kind': 'density', 'data': data, 'path': path, 'title': title, 'xlabel': xlabel,
+        'ylabel': ylabel, 'lines': [list(line) for line in lines]}
+
+def histogram_spec(values, path, title, xlabel, ylabel="Frequency", bins=60, logy=True,
+        cache_dir=RENDER_CACHE_DIR):
+    values = np.asarray(values, dtype=float)
+    data = cached_aggregate("hist", (values, bins), lambda: histogram_bins(values, bins), cache_dir)
+    return {'kind': 'hist', 'data': data, 'path': path, 'title': title, 'xlabel': xlabel,
+        'ylabel': ylabel, 'logy': logy}
+
+def bar_spec(heights, path, title, xlabel, ylabel, xticks=None, xticklabels=None,
+        cache_dir=RENDER_CACHE_DIR):
+    heights = np.asarray(heights, dtype=float)
+    data = cached_aggregate("bar", (heights,), lambda: {'heights': heights}, cache_dir)
+    return {'kind': 'bar', 'data': data, 'path': path, 'title': title, 'xlabel': xlabel,
+        'ylabel': ylabel, 'xticks': None if xticks is None else [int(t) for t in xticks],
+        'xticklabels': xticklabels, 'figsize': [10, 6]}
+
+
+# ------------------------------
+# Rendering
+# ------------------------------
+
+def render_figure(spec, style=None):
+    """Draws one spec (with the keys in style overriding it) and saves it to spec['path']."""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.colors import LogNorm
+    from matplotlib.figure import Figure
+
+    spec = {**spec, **(style or {})}
+    data = np.load(spec['data'])
+    fig = Figure(figsize=spec.get('figsize', (6, 4)))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+
+    if spec['kind'] == 'density':
+        counts = data['counts']
+        x0, x1, y0, y1 = data['extent']
+        image = ax.imshow(np.ma.masked_equal(counts, 0), origin='lower', extent=(x0, x1, y0, y1),
+            aspect='auto', cmap=spec.get('cmap', 'viridis'), norm=LogNorm(vmin=1),
+            interpolation='nearest')
+        fig.colorbar(image, ax=ax, label="Observations")
+        xs = np.array([x0, x1])
+        for intercept, slope, color, label, linestyle in spec.get('lines', []):
+            ax.plot(xs, intercept + slope * xs, color=color, label=label, linestyle=linestyle)
+        ax.set_xlim(x0, x1)
+        ax.set_ylim(y0, y1)
+        if spec.get('lines'):
+            ax.legend()
+    elif spec['kind'] == 'hist':
+        ax.stairs(data['counts'], data['edges'], fill=True, edgecolor='black',
+            color=spec.get('color', 'C0'))
+        if spec.get('logy', True):
+            ax.set_yscale('log')
+    elif spec['kind'] == 'bar':
+        heights = data['heights']
+        ax.bar(np.arange(len(heights)), heights, color=spec.get('color', 'C0'))
+        if spec.get('xticks') is not None:
+            ax.set_xticks(spec['xticks'], spec.get('xticklabels'))
+    else:
+        raise ValueError(f"Unknown figure kind {spec['kind']}.")
+
+    ax.set_title(spec['title'])
+    ax.set_xlabel(spec['xlabel'])
+    ax.set_ylabel(spec['ylabel'])
+    fig.tight_layout()
+    os.makedirs(os.path.dirname(spec['path']) or ".", exist_ok=True)
+    fig.savefig(spec['path'], dpi=spec.get('dpi', 150))
+    return spec['path']
+
+def render_figures(specs, out_dir, n_jobs=-1, style=None):
+    """
+    Renders the specs in parallel worker processes and keeps them in out_dir/figures.json
+    for rerender. Returns the written paths.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, MANIFEST), "w") as f:
+        json.dump(specs, f, indent=1)
+    return Parallel(n_jobs=n_jobs, backend="loky")(delayed(render_figure)(spec, style)
+        for spec in specs)
+
+def rerender(out_dir, style=None, n_jobs=-1):
+    """Renders the figures of an earlier render_figures call again from the cached aggregates."""
+    with open(os.path.join(out_dir, MANIFEST)) as f:
+        specs = json.load(f)
+    return Parallel(n_jobs=n_jobs, backend="loky")(delayed(render_figure)(spec, style)
+        for spec in specs)
@@ -0,0 +1,123 @@
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+from data3 import CURRENCY_RATES
+from rates import RATE_MAPPINGS
+
+# ------------------------------
+# Synthetic input data in the layout of the real files
+# ------------------------------
+#
+# kovadata3.csv cannot be shared, so benchmarks (and anyone without the data) run on
+# generated panels instead: the same 3-row header (underlying, field, country) and 9
+# columns per contract, with a risk_free_rates2.csv and exchange_rates.csv covering the
+# same dates. Prices come from Black-Scholes with noise, so put-call parity holds only
+# approximately, as in the real data.
+
+SYNTHETIC_DIR = "synthetic_data/unprocessed_data"
+COUNTRIES = ('SWEDEN', 'NORWAY', 'DENMARK')
+# Second header row of a contract's 9 columns, in the order of ingest.FIELDS.
+FIELD_LABELS = ['div', 'vol', 'mat', 'strike', 'call', 'price', 'call_v', 'put', 'put_v']
+
+
+def synthetic_dates(n_days, start="2011-01-03"):
+    return pd.bdate_range(start, periods=n_days)
+
+def synthetic_rates(dates, seed=0):
+    """
+    risk_free_rates2.csv for dates: every RIC of RATE_MAPPINGS, in percent, as a per-country
+    random walk between 0 and 5 % plus a term premium growing with the tenor.
+    """
+    rng = np.random.default_rng(seed)
+    columns = {}
+    for country, mapping in RATE_MAPPINGS.items():
+        level = np.clip(2.0 + np.cumsum(rng.normal(0, 0.02, len(dates))), 0.0, 5.0)
+        for tenor, ric in sorted(mapping.items()):
+            if ric not in columns:
+                columns[ric] = level + 0.5 * tenor / 455 + rng.normal(0, 0.01, len(dates))
+    rates = pd.DataFrame(columns, index=pd.Index(dates, name='Date'))
+    return rates[sorted(rates.columns)]
+
+def synthetic_exchange_rates(dates, seed=0):
+    """exchange_rates.csv for dates: a log random walk of the SEK price of every currency."""
+    rng = np.random.default_rng(seed + 1)
+    start = {'DKK': 1.4, 'NOK': 0.95}
+    return pd.DataFrame({column: start.get(currency, 1.0) * np.exp(np.cumsum(rng.normal(0, 0.004, len(dates))))
+        for currency, column in CURRENCY_RATES.items()}, index=pd.Index(dates, name='Date'))
+
+def synthetic_options(n_contracts, n_days, contracts_per_underlying=4, seed=0, start="2011-01-03",
+        rate=0.02):
+    """
+    Wide options frame like read_wide_options returns. Every underlying (a geometric random
+    walk with about two dividends a year) has contracts_per_underlying contracts; a contract
+    is listed on a random day, lives for 30-450 calendar days and is NaN outside that
+    window. Countries rotate over the underlyings.
+    """
+    rng = np.random.default_rng(seed)
+    dates = synthetic_dates(n_days, start)
+    day = dates.values.astype("datetime64[D]").astype(np.int64)
+    n_underlyings = -(-n_contracts // contracts_per_underlying)
+
+    values = np.full((n_days, n_contracts * 9), np.nan)
+    columns = []
+    for u in range(n_underlyings):
+        country = COUNTRIES[u % len(COUNTRIES)]
+        S = 100 * np.exp(np.cumsum(rng.normal(0, 0.015, n_days)))
+        dividend = np.where(rng.random(n_days) < 2 / 252, S * rng.uniform(0.01, 0.03, n_days), 0.0)
+        ulying_volume = rng.lognormal(3, 1, n_days)
+        for g in range(u * contracts_per_underlying, min((u + 1) * contracts_per_underlying, n_contracts)):
+            listed = rng.integers(0, n_days)
+            expiry = day[listed] + rng.integers(30, 451)
+            alive = np.arange(listed, np.searchsorted(day, expiry))
+            T_days = (expiry - day[alive]).astype(float)
+            T = T_days / 365
+            K = np.round(S[listed] * rng.uniform(0.8, 1.2))
+            sigma = rng.uniform(0.15, 0.5)
+            s = S[alive]
+            d1 = (np.log(s / K) + (rate + sigma**2 / 2) * T) / (sigma * np.sqrt(T))
+            d2 = d1 - sigma * np.sqrt(T)
+            noise = rng.normal(0, 0.003, (2, len(alive))) * s
+            call = np.maximum(s * norm.cdf(d1) - K * np.exp(-rate * T) * norm.cdf(d2) + noise[0], 0.01)
+            put = np.maximum(K * np.exp(-rate * T) * norm.cdf(-d2) - s * norm.cdf(-d1) + noise[1], 0.01)
+            block = np.column_stack([
+                dividend[alive], ulying_volume[alive], T_days, np.full(len(alive), K), call, s,
+                rng.poisson(40, len(alive)).astype(float), put, rng.poisson(40, len(alive)).astype(float),
+            ])
+            values[alive, g * 9:(g + 1) * 9] = block
+            columns += [(f"SYN{u:04d}_{g:05d}", label, country) for label in FIELD_LABELS]
+
+    options = pd.DataFrame(values, index=dates, columns=pd.MultiIndex.from_tuples(columns))
+    return options
+
+def write_options_csv(options, path):
+    """Writes a wide options frame in the kovadata3.csv layout read_wide_options reads."""
+    with open(path, "w") as f:
+        for level in range(3):
+            f.write(("Date," if level == 0 else ",") + ",".join(str(c[level]) for c in options.columns) + "\n")
+        body = options.copy()
+        body.index = body.index.strftime('%m/%d/%y')
+        body.to_csv(f, header=False)
+
+def write_synthetic_data(out_dir=SYNTHETIC_DIR, n_contracts=60, n_days=750, seed=0):
+    """
+    Writes kovadata3.csv, risk_free_rates2.csv and exchange_rates.csv for one synthetic
+    panel to out_dir. Point a run at them by running from a directory whose
+    unprocessed_data is out_dir. Returns the three paths.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    options = synthetic_options(n_contracts, n_days, seed=seed)
+    # The rates start a month before the options, so every option date has a rate.
+    rate_dates = synthetic_dates(n_days + 22, options.index[0] - pd.offsets.BDay(22))
+    paths = [os.path.join(out_dir, name) for name in
+        ("kovadata3.csv", "risk_free_rates2.csv", "exchange_rates.csv")]
+    write_options_csv(options, paths[0])
+    synthetic_rates(rate_dates, seed).to_csv(paths[1])
+    synthetic_exchange_rates(rate_dates, seed).to_csv(paths[2])
+    return paths
+
+
+if __name__ == "__main__":
+    print(write_synthetic_data())
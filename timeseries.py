@@ -0,0 +1,186 @@
+import json
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+# ------------------------------
+# Versioned market data store
+# ------------------------------
+#
+# Rates and exchange rates are kept in one SQLite table keyed by (series, day, recorded):
+# every write records only the values that differ from what the store already holds, with
+# the time of the write, so the latest value of a date is its current revision and any
+# earlier state of the data can be read back with known_at. Queries return numpy arrays,
+# and as-of lookups for whole arrays of dates are one searchsorted.
+
+SERIES_DB_PATH = "processed_data/market_data.sqlite"
+# Bound past any day number or recorded time, for "no limit" queries.
+_LAST = np.iinfo(np.int64).max
+
+# (store path, CSV path) -> (size, mtime) of the CSV this process last imported, so an
+# unchanged file is not checked against the store again.
+_imported = {}
+
+
+def day_numbers(dates):
+    """Whole days since the epoch."""
+    return np.asarray(pd.DatetimeIndex(dates).values.astype("datetime64[D]").astype(np.int64))
+
+def _microseconds(known_at):
+    """known_at as microseconds since the epoch (UTC): an int is taken as is, anything else
+    goes through pd.Timestamp."""
+    if known_at is None:
+        return _LAST
+    if isinstance(known_at, (int, np.integer)):
+        return int(known_at)
+    return pd.Timestamp(known_at).value // 1000
+
+
+class SeriesStore:
+    """
+    Daily series (rates in percent, exchange rates, ...) by id. See the section comment for
+    how revisions are kept.
+    """
+
+    def __init__(self, path=SERIES_DB_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS observations (
+                series TEXT NOT NULL, day INTEGER NOT NULL, recorded INTEGER NOT NULL,
+                value REAL NOT NULL, PRIMARY KEY (series, day, recorded)) WITHOUT ROWID""")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS sources (
+                path TEXT PRIMARY KEY, stamp TEXT NOT NULL)""")
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def series_ids(self):
+        return [row[0] for row in self.conn.execute("SELECT DISTINCT series FROM observations ORDER BY series")]
+
+    def version(self, series=None):
+        """Changes whenever anything is written to the given series (default: all)."""
+        query = "SELECT COUNT(*), MAX(recorded) FROM observations"
+        if series is None:
+            return "%s-%s" % self.conn.execute(query).fetchone()
+        series = list(series)
+        marks = ",".join("?" * len(series))
+        return "%s-%s" % self.conn.execute(f"{query} WHERE series IN ({marks})", series).fetchone()
+
+    def history(self, series, known_at=None, start=None, end=None):
+        """
+        (days, values) of a series, sorted by day: the latest revision of every day recorded
+        at or before known_at (default: now). start and end bound the days.
+        """
+        rows = self.conn.execute("""
+            SELECT day, value FROM observations AS o
+            WHERE series = ? AND day BETWEEN ? AND ? AND recorded = (
+                SELECT MAX(recorded) FROM observations
+                WHERE series = o.series AND day = o.day AND recorded <= ?)
+            ORDER BY day""", (series,
+                -_LAST if start is None else int(day_numbers([start])[0]),
+                _LAST if end is None else int(day_numbers([end])[0]),
+                _microseconds(known_at))).fetchall()
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        days, values = zip(*rows)
+        return np.array(days, dtype=np.int64), np.array(values, dtype=float)
+
+    def frame(self, series=None, known_at=None, start=None, end=None):
+        """Wide frame indexed by Date with one column per series that has data."""
+        columns = {}
+        for s in (self.series_ids() if series is None else series):
+            days, values = self.history(s, known_at, start, end)
+            if len(days):
+                columns[s] = pd.Series(values, index=days)
+        df = pd.DataFrame(columns)
+        df.index = pd.DatetimeIndex(np.asarray(df.index, dtype=np.int64).astype("datetime64[D]")
+            .astype("datetime64[ns]"), name='Date')
+        return df
+
+    def asof(self, series, dates, known_at=None):
+        """Value of the last observation on or before each date; NaN before the first one."""
+        days, values = self.history(series, known_at)
+        pos = np.searchsorted(days, day_numbers(dates), side="right") - 1
+        if not len(days):
+            return np.full(len(pos), np.nan)
+        return np.where(pos >= 0, values[np.maximum(pos, 0)], np.nan)
+
+    def revisions(self, series, date):
+        """Every recorded value of one day of a series, oldest first."""
+        rows = self.conn.execute("""SELECT recorded, value FROM observations
+            WHERE series = ? AND day = ? ORDER BY recorded""",
+            (series, int(day_numbers([date])[0]))).fetchall()
+        df = pd.DataFrame(rows, columns=['recorded', 'value'])
+        df['recorded'] = pd.to_datetime(df['recorded'], unit='us')
+        return df
+
+    def write(self, frame, recorded=None):
+        """
+        Records the non-NaN values of frame (indexed by date, one column per series) that
+        differ from the current ones. Returns the number of values written.
+        """
+        if recorded is None:
+            last = self.conn.execute("SELECT MAX(recorded) FROM observations").fetchone()[0]
+            recorded = max(time.time_ns() // 1000, (last or 0) + 1)
+        days = day_numbers(frame.index)
+        rows = []
+        for series in frame.columns:
+            values = frame[series].to_numpy(dtype=float)
+            keep = ~np.isnan(values)
+            new_days, new_values = days[keep], values[keep]
+            cur_days, cur_values = self.history(series)
+            same = np.zeros(len(new_days), dtype=bool)
+            if len(cur_days):
+                pos = np.minimum(np.searchsorted(cur_days, new_days), len(cur_days) - 1)
+                same = (cur_days[pos] == new_days) & (cur_values[pos] == new_values)
+            rows.extend((series, int(d), recorded, float(v))
+                for d, v in zip(new_days[~same], new_values[~same]))
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO observations VALUES (?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def import_csv(self, path, recorded=None):
+        """
+        Writes a CSV with a Date column and one column per series (like
+        risk_free_rates2.csv) into the store, unless this exact file has been imported
+        already. Returns the number of values written.
+        """
+        stat = os.stat(path)
+        stamp = json.dumps([stat.st_size, stat.st_mtime_ns])
+        row = self.conn.execute("SELECT stamp FROM sources WHERE path = ?", (os.path.abspath(path),)).fetchone()
+        if row is not None and row[0] == stamp:
+            return 0
+        written = self.write(pd.read_csv(path, parse_dates=['Date'], index_col='Date'), recorded)
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO sources VALUES (?, ?)", (os.path.abspath(path), stamp))
+        return written
+
+def import_csv_once(path, db_path=SERIES_DB_PATH):
+    """
+    SeriesStore.import_csv of path into the store at db_path, skipped (without opening the
+    store) while path has the size and mtime this process last imported. A missing file is
+    ignored. Returns the number of values written.
+    """
+    if not os.path.exists(path):
+        return 0
+    stat = os.stat(path)
+    key = (os.path.abspath(db_path), os.path.abspath(path))
+    stamp = (stat.st_size, stat.st_mtime_ns)
+    if _imported.get(key) == stamp:
+        return 0
+    with SeriesStore(db_path) as store:
+        written = store.import_csv(path)
+    _imported[key] = stamp
+    return written